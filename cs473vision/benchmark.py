@@ -0,0 +1,413 @@
+import argparse
+import ctypes
+import ctypes.util
+import cv2
+import multiprocessing
+import numpy as np
+import os
+import time
+
+from multiprocessing.pool import ThreadPool
+from obj_baxter import BaxterObject
+from obj_detect import BackgroundModel, SegmentedObject, set_thread_budget
+import obj_shared
+
+def time_segmentation(model, fg_paths, workers, cv_threads, repeat=1):
+    '''
+    Times segmenting and measuring a list of foreground images against a
+    shared background model, under a given thread budget.
+    
+    Args:
+        model: BackgroundModel to segment against.
+        fg_paths: list of file paths to foreground images.
+        workers: number of worker threads.
+        cv_threads: number of OpenCV threads (global to the process).
+        repeat: (optional) number of times to process the list.
+    Returns:
+        Number of images processed per second.
+    '''
+    
+    set_thread_budget(workers, cv_threads)
+    measure = lambda p: SegmentedObject(model, p).get_object_rectangle_size()
+    paths = fg_paths * repeat
+    pool = ThreadPool(workers)
+    start = time.time()
+    pool.map(measure, paths, chunksize=1)
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    return len(paths) / elapsed
+
+def scaling(args):
+    model = BackgroundModel(args.background)
+    max_cores = args.cores or multiprocessing.cpu_count()
+    print "%5s  %18s  %18s" % ("cores", "workers (img/s)", "OpenCV (img/s)")
+    for n in range(1, max_cores + 1):
+        outer = time_segmentation(model, args.foreground, n, 1, args.repeat)
+        inner = time_segmentation(model, args.foreground, 1, n, args.repeat)
+        print "%5d  %18.2f  %18.2f" % (n, outer, inner)
+    return
+
+def dedup(args):
+    print "%10s  %8s  %12s  %10s" % ("threshold", "seconds", "duplicates", "saved (%)")
+    baseline = None
+    for threshold in [None] + args.threshold:
+        baxter = BaxterObject(args.background)
+        baxter.set_compressed_dedup(not threshold is None, threshold)
+        start = time.time()
+        baxter.set_compressed_image(args.directory)
+        baxter.get_compressed_size(all=True)
+        elapsed = time.time() - start
+        if baseline is None:
+            baseline = elapsed
+        print "%10s  %8.3f  %5d / %4d  %10.1f" % (threshold, elapsed, 
+            sum(baxter.compress_dup), len(baxter.compress_dup),
+            100 * (baseline - elapsed) / baseline)
+    return
+
+_POSIX_FADV_DONTNEED = 4 # Linux
+
+def evict_page_cache(paths):
+    '''
+    Asks the operating system to drop files from its page cache, so that 
+    they are read from disk again, as on a cold start. Unlike dropping the
+    whole cache, this needs no root privileges, but is only supported where 
+    the C library has posix_fadvise() (e.g. Linux).
+    
+    Args:
+        paths: list of file paths.
+    Returns:
+        True if the files were evicted; false if not supported.
+    '''
+    
+    libc = ctypes.CDLL(ctypes.util.find_library("c"))
+    fadvise = getattr(libc, "posix_fadvise", None)
+    if fadvise is None:
+        return False
+    fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, 
+                        ctypes.c_int]
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if fadvise(fd, 0, 0, _POSIX_FADV_DONTNEED) != 0:
+                return False
+        finally:
+            os.close(fd)
+    return True
+
+def prefetch(args):
+    paths = [os.path.join(args.directory, f) for f in os.listdir(args.directory)
+             if f.endswith(".png") or f.endswith(".jpg")]
+    cold = not args.warm
+    if cold and not evict_page_cache(paths):
+        print "Page cache eviction not supported - timing warm cache."
+        cold = False
+    print "%6s  %5s  %8s  %10s" % ("depth", "cache", "seconds", "saved (%)")
+    baseline = None
+    for depth in [0] + args.depth:
+        baxter = BaxterObject(args.background)
+        baxter.set_thread_budget(1, args.cv_threads)
+        baxter.set_prefetch(depth)
+        baxter.set_measure_only()
+        baxter._get_background() # built before the timed region
+        if cold:
+            evict_page_cache(paths)
+        start = time.time()
+        baxter.set_compressed_image(args.directory)
+        elapsed = time.time() - start
+        if baseline is None:
+            baseline = elapsed
+        print "%6d  %5s  %8.3f  %10.1f" % (depth, "cold" if cold else "warm",
+            elapsed, 100 * (baseline - elapsed) / baseline)
+    return
+
+def compare_methods(model, fg_path, method_a, method_b):
+    '''
+    Segments a foreground image with two methods, and compares their run 
+    times and results.
+    
+    Args:
+        model: BackgroundModel to segment against.
+        fg_path: file path to foreground image.
+        method_a: reference segmentation method.
+        method_b: segmentation method to compare to method_a.
+    Returns:
+        A 4-tuple: the seconds taken by method_a and by method_b, the 
+        intersection over union of their object masks, and the largest
+        difference between their minimum area rectangle dimensions.
+    '''
+    
+    img = cv2.imread(fg_path) # decode outside of the timed region
+    results = []
+    for method in (method_a, method_b):
+        start = time.time()
+        obj = SegmentedObject(model, img, method)
+        obj.measure()
+        results.append((time.time() - start, obj))
+    (time_a, obj_a), (time_b, obj_b) = results
+    mask_a = obj_a.get_object_mask()
+    mask_b = obj_b.get_object_mask()
+    union = np.count_nonzero(cv2.bitwise_or(mask_a, mask_b))
+    inter = np.count_nonzero(cv2.bitwise_and(mask_a, mask_b))
+    iou = float(inter) / union if union else 1.0
+    size_a = obj_a.get_object_rectangle_size(True)
+    size_b = obj_b.get_object_rectangle_size(True)
+    size_diff = max(abs(size_a[0] - size_b[0]), abs(size_a[1] - size_b[1]))
+    return (time_a, time_b, iou, size_diff)
+
+def gray(args):
+    model = BackgroundModel(args.background)
+    model.get_gray() # cached once, as in BaxterObject
+    print "%-30s  %10s  %10s  %6s  %10s" % ("image", "simple (s)", 
+        "gray (s)", "IoU", "size diff")
+    totals = np.zeros(2)
+    for fg_path in args.foreground:
+        t_a, t_b, iou, size_diff = compare_methods(model, fg_path, "simple",
+                                                   "simple-gray")
+        totals += (t_a, t_b)
+        print "%-30s  %10.4f  %10.4f  %6.3f  %10.1f" % (fg_path[-30:], t_a, 
+                                                        t_b, iou, size_diff)
+    print "Speedup: %.2fx" % (totals[0] / totals[1])
+    return
+
+def threshold(args):
+    model = BackgroundModel(args.background)
+    color_range = None
+    if args.color:
+        color_range = (args.color[:3], args.color[3:])
+    imgs = [cv2.imread(p) for p in args.foreground] # decode outside timing
+    print "%-8s  %8s  %16s  %14s" % ("mode", "seconds", "thresholds", 
+                                     "size diff (px)")
+    reference = None
+    for mode in ("whole", "roi", "series"):
+        setting = {"whole": None, "roi": "roi", "series": "roi"}[mode]
+        sizes = []
+        values = []
+        start = time.time()
+        for img in imgs:
+            obj = SegmentedObject(model, img, "simple", color_range,
+                                  args.rectangle, setting)
+            sizes.append(obj.get_object_rectangle_size(True))
+            values.append(obj.threshold_value)
+            if mode == "series": # reuse the first image's threshold
+                setting = values[0]
+        elapsed = time.time() - start
+        if reference is None:
+            reference = np.array(sizes)
+        diff = np.abs(np.array(sizes) - reference).max() if sizes else 0
+        print "%-8s  %8.3f  %7.1f - %6.1f  %14.1f" % (mode, elapsed, 
+            min(values), max(values), diff)
+    return
+
+def cleanup(args):
+    model = BackgroundModel(args.background)
+    settings = [None, ("open", 3), ("open", 5), ("close", 3), 
+                ("open-close", 3)]
+    counts = np.zeros(len(settings))
+    stage_times = np.zeros(len(settings))
+    segment_time = 0.0
+    for fg_path in args.foreground:
+        img = cv2.imread(fg_path) # decode outside of the timed region
+        start = time.time()
+        obj = SegmentedObject(model, img)
+        segment_time += time.time() - start
+        for i, setting in enumerate(settings):
+            obj.set_cleanup(*(setting or (None,)))
+            start = time.time()
+            geometry = obj.measure()
+            stage_times[i] += time.time() - start
+            counts[i] += geometry.contour_count
+    n = len(args.foreground)
+    print "%-14s  %10s  %14s  %14s" % ("cleanup", "contours", 
+        "contours (ms)", "end-to-end (ms)")
+    for i, setting in enumerate(settings):
+        name = "%s %d" % setting if setting else "none"
+        print "%-14s  %10.1f  %14.2f  %14.2f" % (name, counts[i] / n, 
+            1000 * stage_times[i] / n, 1000 * (segment_time + stage_times[i]) / n)
+    return
+
+_worker_model = None # BackgroundModel of a "reload" worker process
+
+def _init_reload(bg_path):
+    global _worker_model
+    _worker_model = BackgroundModel(bg_path)
+    return
+
+def _measure_reloaded(fg_path):
+    return SegmentedObject(_worker_model, fg_path).release()
+
+def _measure_pickled((model, fg_path)):
+    return SegmentedObject(model, fg_path).release()
+
+def worker_memory_mb(pid):
+    '''
+    Returns the proportional and unique set size of a process (PSS and USS):
+    its resident memory with each shared page split among the processes
+    sharing it, or left out. Unlike the peak resident memory, which counts
+    every shared page a worker has touched, these tell memory shared 
+    between processes apart. Linux only.
+    
+    Args:
+        pid: process ID.
+    Returns:
+        A pair (pss, uss) in megabytes, or None if it is not available.
+    '''
+    
+    fields = {}
+    for name in ("smaps_rollup", "smaps"): # smaps_rollup since Linux 4.14
+        try:
+            with open("/proc/%d/%s" % (pid, name)) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[2] == "kB":
+                        fields[parts[0]] = fields.get(parts[0], 0) + int(parts[1])
+            break
+        except IOError:
+            fields = {}
+    else:
+        return None
+    uss = fields.get("Private_Clean:", 0) + fields.get("Private_Dirty:", 0)
+    return (fields.get("Pss:", 0) / 1024.0, uss / 1024.0)
+
+def time_processes(mode, bg_path, fg_paths, processes, results):
+    '''
+    Times segmenting and measuring foreground images in a pool of worker
+    processes, which get the background in one of three ways: "shared" (a
+    SharedBackground, attached once per worker), "pickled" (a pickled copy
+    of the BackgroundModel sent with every image), or "reload" (each worker
+    reads and filters the background image itself). Meant to run in its own 
+    process, so its workers are not mixed up with others'.
+    
+    Args:
+        mode: "shared", "pickled", or "reload".
+        bg_path: file path to background image.
+        fg_paths: list of file paths to foreground images.
+        processes: number of worker processes.
+        results: multiprocessing.Queue to put a 3-tuple on: the seconds until
+                 the first result, the total seconds, and the largest PSS 
+                 and USS of a worker after the run (see worker_memory_mb()),
+                 or None.
+    '''
+    
+    set_thread_budget(processes, 1)
+    model = BackgroundModel(bg_path) # built before the timed region
+    start = time.time()
+    if mode == "shared":
+        shared = obj_shared.SharedBackground(model)
+        pool = multiprocessing.Pool(processes, obj_shared._init_shared, 
+                                    (shared,))
+        geometries = pool.imap(obj_shared._measure, 
+                               [(p, "simple", None) for p in fg_paths])
+    elif mode == "pickled":
+        pool = multiprocessing.Pool(processes)
+        geometries = pool.imap(_measure_pickled, [(model, p) for p in fg_paths])
+    else:
+        pool = multiprocessing.Pool(processes, _init_reload, (bg_path,))
+        geometries = pool.imap(_measure_reloaded, fg_paths)
+    geometries.next()
+    first = time.time() - start
+    list(geometries)
+    total = time.time() - start
+    memory = [worker_memory_mb(p.pid) for p in pool._pool] # still alive
+    pool.close()
+    pool.join()
+    memory = None if None in memory else tuple(max(m) for m in zip(*memory))
+    results.put((first, total, memory))
+    return
+
+def shared(args):
+    processes = args.processes or multiprocessing.cpu_count()
+    print "%-8s  %10s  %10s  %16s  %16s" % ("mode", "first (s)", "total (s)", 
+                                            "worker PSS (MB)", "worker USS (MB)")
+    results = multiprocessing.Queue()
+    for mode in ("shared", "pickled", "reload"):
+        runner = multiprocessing.Process(target=time_processes, args=(mode, 
+            args.background, args.foreground, processes, results))
+        runner.start()
+        first, total, memory = results.get()
+        runner.join()
+        if memory is None:
+            print "%-8s  %10.3f  %10.3f  %16s  %16s" % (mode, first, total, 
+                                                        "n/a", "n/a")
+        else:
+            print "%-8s  %10.3f  %10.3f  %16.1f  %16.1f" % ((mode, first, 
+                                                             total) + memory)
+    return
+
+# Benchmark script for the cs473vision modules
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark object segmentation.")
+    subparsers = parser.add_subparsers(title="benchmarks")
+    
+    sub = subparsers.add_parser("scaling", help="images per second at 1..N "
+                                "cores, split as workers or OpenCV threads")
+    sub.add_argument("background", help="path to background image")
+    sub.add_argument("foreground", nargs='+', help="path to foreground image(s)")
+    sub.add_argument("-n", "--cores", type=int, metavar="N",
+                     help="maximum number of cores to use")
+    sub.add_argument("-r", "--repeat", type=int, default=1, metavar="N",
+                     help="number of times to process the images")
+    sub.set_defaults(func=scaling)
+    
+    sub = subparsers.add_parser("dedup", help="time saved by skipping "
+                                "near-duplicate compressed images")
+    sub.add_argument("background", help="path to background image")
+    sub.add_argument("directory", help="directory of compressed images")
+    sub.add_argument("-d", "--threshold", nargs='+', type=float, 
+                     default=[0.5, 1.0, 2.0], metavar="T",
+                     help="deduplication thresholds to try")
+    sub.set_defaults(func=dedup)
+    
+    sub = subparsers.add_parser("prefetch", help="time saved by loading the "
+                                "next compressed images while segmenting")
+    sub.add_argument("background", help="path to background image")
+    sub.add_argument("directory", help="directory of compressed images")
+    sub.add_argument("-d", "--depth", nargs='+', type=int, default=[1, 2, 4],
+                     metavar="N", help="prefetch depths to try")
+    sub.add_argument("-t", "--cv-threads", type=int, default=1, metavar="N",
+                     help="number of OpenCV threads")
+    sub.add_argument("--warm", action="store_true",
+                     help="keep the images in the page cache between runs")
+    sub.set_defaults(func=prefetch)
+    
+    sub = subparsers.add_parser("gray", help="speed and accuracy of the "
+                                "simple-gray method against simple")
+    sub.add_argument("background", help="path to background image")
+    sub.add_argument("foreground", nargs='+', help="path to foreground image(s)")
+    sub.set_defaults(func=gray)
+    
+    sub = subparsers.add_parser("threshold", help="speed and accuracy of Otsu "
+                                "thresholding over the whole image, the "
+                                "region of interest, or once per series")
+    sub.add_argument("background", help="path to background image")
+    sub.add_argument("foreground", nargs='+', help="path to foreground image(s)")
+    sub.add_argument("-c", "--color", nargs=6, type=int, 
+                     metavar=("HUE_LOW", "SAT_LOW", "VAL_LOW",
+                              "HUE_HIGH", "SAT_HIGH", "VAL_HIGH"),
+                     help="specify ignored color")
+    sub.add_argument("-r", "--rectangle", nargs=4, type=int,
+                     metavar=("X", "Y", "WIDTH", "HEIGHT"),
+                     help="specify rectangle region of interest")
+    sub.set_defaults(func=threshold)
+    
+    sub = subparsers.add_parser("cleanup", help="contour counts and latency "
+                                "with morphological mask cleanup")
+    sub.add_argument("background", help="path to background image")
+    sub.add_argument("foreground", nargs='+', help="path to foreground image(s)")
+    sub.set_defaults(func=cleanup)
+    
+    sub = subparsers.add_parser("shared", help="startup time and memory of "
+                                "worker processes sharing the background, "
+                                "against pickling or reloading it")
+    sub.add_argument("background", help="path to background image")
+    sub.add_argument("foreground", nargs='+', help="path to foreground image(s)")
+    sub.add_argument("-n", "--processes", type=int, metavar="N",
+                     help="number of worker processes")
+    sub.set_defaults(func=shared)
+    
+    args = parser.parse_args()
+    args.func(args)
+    return
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,32 @@ Created on Mar 29, 2014
 @author: Vance Zuo
 '''
 
+import copy
 import csv
 import cv2
+import itertools
+import json
 import numpy as np
 import os
 
-from obj_detect import SegmentedObject, check_fit
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from obj_detect import ArchiveMember, BackgroundModel, SegmentedObject
+from obj_detect import Undistorter
+from obj_detect import check_fit, load_image, open_video, prefetch_images
+from obj_detect import SEGMENT_METHODS, set_thread_budget, thumbnail
+from obj_shared import SharedBackground
+from pipeline import Pipeline
+from profiling import stage
+
+# Numeric columns of the size tables, in order, as named in .npz exports
+SIZE_COLUMNS = ("width_px", "height_px", "w_change_px", "h_change_px",
+                "width_mm", "height_mm", "w_change_mm", "h_change_mm")
+
+# Size record of one compressed object image, as yielded by 
+# BaxterObject.iter_compressed_sizes()
+FrameSize = namedtuple("FrameSize", ["index", "path", "width", "height", 
+                                     "duplicate"])
 
 class BaxterObject(object):
     '''
@@ -34,13 +54,17 @@ class BaxterObject(object):
     series of export methods.
     
     Attributes:
-        bg_path: file path to the background reference image.
+        bg_path: file path to the background reference image. If several
+                 background images were set, the first one.
         meassure_obj: SegmentedObject of measurement reference object.
         box_obj: SegmentedObject of the reference box.
         uncompress_obj: SegmentedObject of target object, uncompressed.
         arm_obj: SegmentedObject of the robot manipulating arm.
         compress_obj: list of SegmentedObject of target object, compressed 
                       (with the arm presumably in the picture.
+        compress_dup: list of booleans, parallel to compress_obj, denoting
+                      which compressed images were near-duplicates of the
+                      previous image (and so reuse its segmentation).
     '''
 
     def __init__(self, bg_path, measure_path=None, box_path=None, obj_path=None, 
@@ -61,19 +85,38 @@ class BaxterObject(object):
         '''
 
         self.bg_path = bg_path
+        self._bg_model = None # built from bg_path when first needed
+        self._bg_model_paths = None
+        self._undistorter = None # lens distortion is ignored if None
         self.measure_obj = None
         self.box_obj = None
         self.uncompress_obj = None
         self.arm_obj = None
         self.compress_obj = []
+        self.compress_dup = []
         #self.compress_force = []
         
+        self._mm_per_px = None # overrides the measurement reference if not None
         self._measure_size = None # overrides measure_obj if not None
         self._measure_mm = None
+        self._calibrated = set() # parts loaded by load_calibration()
         self._box_size = None # overrides box_obj for dimensions if not None
         self._color_tol = None
         self._color_low = None
         self._color_high = None
+        self._compress_rect = None # static ROI of compressed object images
+        self._track_margin = None # tracking disabled if None
+        self._workers = 1
+        self._method = "simple"
+        self._compress_threshold = None # see SegmentedObject.set_threshold()
+        self._threshold_series = False # reuse first image's threshold if True
+        self._series_threshold = None
+        self._series_computed = False # whether the first image was thresholded
+        self._cleanup = None # see SegmentedObject.set_cleanup()
+        self._dedup_threshold = None # deduplication disabled if None
+        self._dedup_thumb = None # thumbnail of last non-duplicate image
+        self._measure_only = False # release compressed images if True
+        self._prefetch = 0 # images loaded ahead on a background thread
         
         self.set_box_image(box_path)
         self.set_uncompressed_image(obj_path)
@@ -136,6 +179,8 @@ class BaxterObject(object):
         
         if self._color_low is None or self._color_high is None:
             return False
+        if self.compress_obj[0].fg_img is None: # released
+            return False
         self.compress_obj[0].export_region_segment(output_path)
         return True
         
@@ -162,55 +207,140 @@ class BaxterObject(object):
         
         Args:
             output_path: file path of output image.
+            min_area: whether to pick the image with the smallest object by 
+                      its minimum area bounding rectangle, instead of its
+                      upright bounding rectangle.
+            all: whether to write every image's cut-out instead, numbering
+                 the file names from 1 (released images are skipped).
         '''
         
         if not self.compress_obj:
             return False
         if not all:
-            all_dim = [x.get_object_rectangle_size(min_area) for x in self.compress_obj]
+            all_dim = [x.measure().size(min_area) for x in self.compress_obj]
             all_area = [y[0]*y[1] for y in all_dim]
             min_obj = self.compress_obj[np.argmin(all_area)]
+            if min_obj.fg_img is None: # released
+                return False
             min_obj.export_object_segment(output_path)
             return True
-        for i in range(1, len(self.compress_obj)):
-            path_split = os.path.splitext(output_path)
+        path_split = os.path.splitext(output_path)
+        for i, obj in enumerate(self.compress_obj, 1):
+            if obj.fg_img is None: # released
+                continue
             path = path_split[0] + "-" + str(i) + path_split[1]
-            obj.export_object_segment(output_path)
+            obj.export_object_segment(path)
         return True
     
-    def export_sizes(self, output_path):
+    def export_compress_video(self, output_path, fps=10.0, codec="MJPG"):
+        '''
+        Writes cut-outs of the compressed target object in every compressed 
+        object image, with their upright bounding rectangles drawn, as the 
+        frames of one video file. Each frame is encoded as soon as it is cut
+        out, so they are never all held in memory. Released images (see
+        set_measure_only()) are skipped.
+        
+        Args:
+            output_path: file path of output video (e.g. .avi).
+            fps: (optional) frames per second.
+            codec: (optional) four character code of the video codec.
+        Returns:
+            True if at least one frame was written; false otherwise.
+        '''
+        
+        sink = _SegmentSink(video_path=output_path, fps=fps, codec=codec)
+        try:
+            for obj in self.compress_obj:
+                if not obj.fg_img is None:
+                    sink.write(obj.label, obj)
+        finally:
+            sink.close()
+        return sink.frames > 0
+    
+    def export_sizes(self, output_path, stream=None):
         '''
         Writes in CSV format a table of the BaxterObject's object dimensions,
         including the reference, box, uncompressed, and compressed objects.
         
+        The compressed object dimensions can instead be taken from a stream 
+        of FrameSize records (see iter_compressed_sizes()), in which case each
+        row is written as soon as its record arrives, and the compressed 
+        images loaded into the BaxterObject are ignored.
+        
+        If deduplication is enabled (see set_compressed_dedup()), a final
+        "Duplicate" column denotes the compressed images that reused the
+        previous image's segmentation.
+        
         Args:
             output_path: file path of output CSV.
+            stream: (optional) iterable of FrameSize records.
         '''
         
+        dedup = not self._dedup_threshold is None
         with open(output_path, 'wb') as f:
             writer = csv.writer(f)
-            writer.writerow(["Object", "Width-px", "Height-px", "W-change-px",
-                             "H-change-px", "Width-mm", "Height-mm", 
-                             "W-change-mm", "H-change-mm"])
-            
-            mm_px = self.get_mm_per_px()
-            
-            w, h = self.get_measure_size()
-            writer.writerow(["reference-measure", w, h, 0, 0, w*mm_px, h*mm_px, 0, 0])
-            w, h = self.get_box_size()
-            writer.writerow(["reference-box", w, h, 0, 0, w*mm_px, h*mm_px, 0, 0])
-            
-            w, h = self.get_uncompressed_size()
-            writer.writerow(["uncompressed", w, h, 0, 0, w*mm_px, h*mm_px, 0, 0])
-            compressed_sizes = self.get_compressed_size(all=True)
-            for i in range(len(self.compress_obj)):
-                w_c, h_c = compressed_sizes[i]
-                w_chg = w_c - w
-                h_chg = h_c - h
-                writer.writerow(["compressed-"+str(i), w_c, h_c, w_chg, h_chg, 
-                                 w_c*mm_px, h_c*mm_px, w_chg*mm_px, h_chg*mm_px])
+            header = ["Object", "Width-px", "Height-px", "W-change-px",
+                      "H-change-px", "Width-mm", "Height-mm", 
+                      "W-change-mm", "H-change-mm"]
+            writer.writerow(header + ["Duplicate"] if dedup else header)
+            for row in self._get_size_rows(stream):
+                with stage("export", output_path): # rows may be computed lazily
+                    writer.writerow(row if dedup else row[:-1])
         return True  
     
+    def export_sizes_npz(self, output_path, stream=None):
+        '''
+        Writes the same table as export_sizes() in NumPy's binary .npz format,
+        one typed array per column, which is much faster to read back in bulk
+        than CSV (see load_sizes_npz()). 
+        
+        Besides the columns ("object", "width_px", "height_px", "w_change_px",
+        "h_change_px", "width_mm", "height_mm", "w_change_mm", "h_change_mm",
+        and the boolean "duplicate"), the file holds the metadata "mm_per_px" 
+        and "bg_path".
+        
+        Args:
+            output_path: file path of output .npz file.
+            stream: (optional) iterable of FrameSize records to take the 
+                    compressed object dimensions from (see export_sizes()).
+        '''
+        
+        rows = list(self._get_size_rows(stream))
+        names = np.array([row[0] for row in rows], dtype=np.str_)
+        values = np.array([row[1:-1] for row in rows], dtype=np.float64)
+        values = values.reshape(len(rows), len(SIZE_COLUMNS))
+        columns = dict((c, values[:, i]) for i, c in enumerate(SIZE_COLUMNS))
+        duplicate = np.array([row[-1] for row in rows], dtype=np.bool_)
+        with stage("export", output_path), open(output_path, 'wb') as f:
+            np.savez(f, object=names, duplicate=duplicate, 
+                     mm_per_px=self.get_mm_per_px(), 
+                     bg_path=str(self.bg_path), **columns)
+        return True
+    
+    def set_background_images(self, bg_paths):
+        '''
+        Builds the background model from several background images, instead
+        of the single image at bg_path. The model (per-pixel median and noise
+        estimate) is computed once and shared by all objects segmented
+        afterwards, making their thresholds more stable and their noise
+        filtering unnecessary.
+        
+        Args:
+            bg_paths: list of file paths to background images of the same
+                      dimensions.
+        Returns:
+            True if background images were loaded successfully; false 
+            otherwise.
+        '''
+        
+        if not bg_paths:
+            return False
+        self._bg_model = None
+        self._bg_model_paths = list(bg_paths)
+        self.bg_path = bg_paths[0]
+        self._get_background()
+        return True
+    
     def set_measure_dimensions(self, mm_per_px):
         '''
         Hard codes the millimeters per pixel resolution for the images in
@@ -220,7 +350,111 @@ class BaxterObject(object):
         Args:
             mm_per_px: millimter per pixel to use.
         '''
-        self._measure_size = mm_per_px
+        self._mm_per_px = mm_per_px
+        return True
+    
+    def save_calibration(self, output_path):
+        '''
+        Writes the BaxterObject's calibration profile in JSON format: the 
+        millimeter per pixel resolution, the measurement reference size (in
+        pixels and millimeters), the compressed object region of interest
+        and threshold, and the arm color range and tolerances. As long as 
+        the camera rig is unchanged, later runs can load it with 
+        load_calibration() instead of segmenting the reference and arm 
+        images again.
+        
+        Args:
+            output_path: file path of output JSON file.
+        Returns:
+            True if the profile was written; false otherwise.
+        '''
+        
+        def numbers(values, cast=int):
+            return None if values is None else [cast(v) for v in values]
+        measure_size = None
+        if not self._measure_size is None or not self.measure_obj is None:
+            measure_size = numbers(self.get_measure_size(), float)
+        profile = {"mm_per_px": float(self.get_mm_per_px()),
+                   "measure_size": measure_size,
+                   "measure_mm": numbers(self._measure_mm, float),
+                   "compress_roi": numbers(self._compress_rect),
+                   "compress_threshold": self._compress_threshold,
+                   "arm_color_low": numbers(self._color_low),
+                   "arm_color_high": numbers(self._color_high),
+                   "arm_tolerance": numbers(self._color_tol)}
+        try:
+            with open(output_path, 'w') as f:
+                json.dump(profile, f, indent=2, sort_keys=True)
+        except IOError:
+            return False
+        return True
+    
+    def load_calibration(self, profile_path):
+        '''
+        Loads a calibration profile written by save_calibration(), replacing
+        the parts of the calibration that it provides: the millimeter per 
+        pixel resolution and measurement reference size (if the profile has
+        a measurement), the compressed object region of interest and 
+        threshold (if saved), and the arm color range (if saved). The 
+        measurement reference and arm images are then no longer needed, for
+        the parts the profile provided (and BaxterExperiment.import_images()
+        skips them). The compressed threshold series setting is kept.
+        
+        The whole profile is validated before any of it is applied, so an 
+        invalid profile leaves the BaxterObject unchanged. A profile is 
+        invalid if a value is not a number (e.g. true or false), the arm
+        colors or tolerances are outside the HSV domain (see 
+        set_arm_color()), the region of interest is empty, or the threshold
+        is not a setting of set_compressed_threshold().
+        
+        Args:
+            profile_path: file path to JSON calibration profile.
+        Returns:
+            True if the profile was read and applied; false otherwise.
+        '''
+        
+        try:
+            with open(profile_path) as f:
+                profile = json.load(f)
+            mm_per_px = float(_profile_number(profile, "mm_per_px"))
+            measure_size = _profile_values(profile, "measure_size", 2, float)
+            measure_mm = _profile_values(profile, "measure_mm", 2, float)
+            roi = _profile_values(profile, "compress_roi", 4, int)
+            color_low = _profile_values(profile, "arm_color_low", 3, int)
+            color_high = _profile_values(profile, "arm_color_high", 3, int)
+            tol = _profile_values(profile, "arm_tolerance", 3, int)
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+        threshold = profile.get("compress_threshold", self._compress_threshold)
+        if not (threshold is None or threshold == "roi" or 
+                (isinstance(threshold, (int, float)) and 
+                 not isinstance(threshold, bool) and 0 <= threshold <= 255)):
+            return False
+        for values in (color_low, color_high, tol): # hue, saturation, value
+            if not values is None and not all(0 <= v <= limit for v, limit
+                                              in zip(values, (180, 256, 256))):
+                return False
+        if not roi is None and (min(roi[:2]) < 0 or min(roi[2:]) <= 0):
+            return False
+        
+        if mm_per_px > 0: # else no measurement was saved
+            self._mm_per_px = mm_per_px
+            self._measure_size = measure_size
+            self._measure_mm = measure_mm
+            self.measure_obj = None
+            self._calibrated.add("measure")
+        if not roi is None:
+            self._compress_rect = roi
+            for obj in self.compress_obj:
+                obj.set_rectangle(*self._compress_rect)
+                obj.reset_search_rectangle()
+        if threshold != self._compress_threshold:
+            self.set_compressed_threshold(threshold, self._threshold_series)
+        if not color_low is None and not color_high is None:
+            self._set_color_range(list(color_low), list(color_high))
+            self._color_tol = None if tol is None else list(tol)
+            self.arm_obj = None
+            self._calibrated.add("arm")
         return True
     
     def set_measure_image(self, measure_path, width_mm, height_mm):
@@ -240,9 +474,10 @@ class BaxterObject(object):
         
         if measure_path is None:
             return False
-        self.measure_obj = SegmentedObject(self.bg_path, measure_path)
+        self.measure_obj = self._new_object(measure_path)
         self._measure_mm = (width_mm, height_mm)
         self._measure_size = None
+        self._mm_per_px = None
         return True       
     
     def set_measure_roi(self, x, y, w, h, xy_type="absolute", dim_type="absolute"):
@@ -276,6 +511,8 @@ class BaxterObject(object):
         if self.measure_obj is None:
             return False
         rect = self._get_roi(self.measure_obj, x, y, w, h, xy_type, dim_type)
+        if rect is None:
+            return False
         self.measure_obj.set_rectangle(*rect)
         return True
     
@@ -308,7 +545,7 @@ class BaxterObject(object):
         
         if box_path is None:
             return False
-        self.box_obj = SegmentedObject(self.bg_path, box_path)
+        self.box_obj = self._new_object(box_path)
         self._box_size = None
         return True
     
@@ -343,6 +580,8 @@ class BaxterObject(object):
         if self.box_obj is None:
             return False
         rect = self._get_roi(self.box_obj, x, y, w, h, xy_type, dim_type)
+        if rect is None:
+            return False
         self.box_obj.set_rectangle(*rect)
         return True
     
@@ -351,6 +590,9 @@ class BaxterObject(object):
         Hard codes the color range of the robot arm, which will be ignored in
         the segmentation of the compressed object image. Previous color range 
         settings, including that determined from the arm image, are overriden.
+        Compressed object images that are already loaded only recompute their
+        masks and dimensions when next used (see 
+        SegmentedObject.set_ignore_color()); released images keep theirs.
         
         The colors should be in HSV space, with the domain of hue = 0 to 180,
         saturation = 0 to 256, and value = 0 to 256.
@@ -370,8 +612,7 @@ class BaxterObject(object):
             return False
         if not (0 <= color_low[2]  <= 256) or not (0 <= color_high[2] <= 256):
             return False
-        self._color_low = color_low
-        self._color_high = color_high
+        self._set_color_range(color_low, color_high)
         return True
      
     def set_arm_image(self, arm_path, hue_tolerance=60, 
@@ -406,16 +647,49 @@ class BaxterObject(object):
             return False
         if not (0 <= value_tolerance <= 256):
             return False
-        self.arm_obj = SegmentedObject(self.bg_path, arm_path)      
+        self.arm_obj = self._new_object(arm_path)      
         self._color_tol = [hue_tolerance, saturation_tolerance, value_tolerance]
         self._update_arm_color()
         return True
     
+    def set_arm_tolerance(self, hue_tolerance, saturation_tolerance, 
+                          value_tolerance):
+        '''
+        Sets the size of the arm's color range in hue, saturation, and value,
+        and recalculates the range from the arm image (see set_arm_image() 
+        for details). The loaded compressed object images are updated as in
+        set_arm_color().
+        
+        Args:
+            hue_tolerance: size of the hue range for the arm's color.
+            saturation_tolerance: size of saturation range for the arm's color.
+            value_tolerance: size of the value range for the arm's color.
+        Returns:
+            True if the arm image is set and the tolerances are valid; false
+            otherwise.
+        '''
+        
+        if self.arm_obj is None:
+            return False
+        if not (0 <= hue_tolerance <= 180):
+            return False
+        if not (0 <= saturation_tolerance <= 256):
+            return False
+        if not (0 <= value_tolerance <= 256):
+            return False
+        tolerances = [hue_tolerance, saturation_tolerance, value_tolerance]
+        if tolerances == self._color_tol:
+            return True # color range unchanged
+        self._color_tol = tolerances
+        self._update_arm_color()
+        return True
+    
     def set_arm_roi(self, x, y, w, h, xy_type="absolute", dim_type="absolute"):
         '''
         Limits to a rectangle area the region that will be processed when 
         segmenting the arm object, and recalculates its color range (see
-        set_arm_image() for color range calculation details)).
+        set_arm_image() for color range calculation details)). The loaded
+        compressed object images are updated as in set_arm_color().
         
         The parameters (x,y) and (w[idth], h[eight]) can be specified in 
         either absolute or relative terms. Relative terms are treated 
@@ -444,6 +718,10 @@ class BaxterObject(object):
         if self.arm_obj is None:
             return False
         rect = self._get_roi(self.arm_obj, x, y, w, h, xy_type, dim_type)
+        if rect is None:
+            return False
+        if rect == self.arm_obj.rect:
+            return True # color range unchanged
         self.arm_obj.set_rectangle(*rect)
         self._update_arm_color()
         return True
@@ -461,7 +739,7 @@ class BaxterObject(object):
         
         if uncompressed_path is None:
             return False
-        self.uncompress_obj = SegmentedObject(self.bg_path, uncompressed_path)
+        self.uncompress_obj = self._new_object(uncompressed_path)
         return True
     
     def set_uncompressed_roi(self, x, y, w, h, xy_type="absolute", 
@@ -497,6 +775,8 @@ class BaxterObject(object):
         if self.uncompress_obj is None:
             return False
         rect = self._get_roi(self.uncompress_obj, x, y, w, h, xy_type, dim_type)
+        if rect is None:
+            return False
         self.uncompress_obj.set_rectangle(*rect)
         return True
             
@@ -507,8 +787,17 @@ class BaxterObject(object):
         color as it will be ignored. Thus, the compressed object should have
         a different color from the arm.
         
+        A directory path can also be given, in which case all PNG and JPG 
+        images in it are loaded in alphabetical order, segmented in parallel 
+        by the worker threads set with set_thread_budget(). In measure-only
+        mode (see set_measure_only()), only a few images are loaded at a 
+        time, and each is released as soon as it is measured. With a single
+        worker, the next images can be loaded while the current one is 
+        segmented (see set_prefetch()).
+        
         Args:
-            compressed_path: file path to arm object image. 
+            compressed_path: file path to compressed object image, or an 
+                             ArchiveMember (see obj_detect.read_archive()).
             add: boolean denoting whether to add the compressed image to the
                  list of images, or to create a new list starting with the
                  current image.
@@ -521,19 +810,79 @@ class BaxterObject(object):
         
         if compressed_path is None:
             return False
-        if os.path.isdir(compressed_path):
-            for file in sorted(os.listdir(compressed_path)):
-                if file.endswith(".png") or file.endswith(".jpg"):
-                    self.set_compressed_image(compressed_path + file)
-        new_obj = SegmentedObject(self.bg_path, compressed_path)
-        if not self._color_low is None and not self._color_high is None:
-            new_obj.set_ignore_color(self._color_low, self._color_high)
-        if add:
-            self.compress_obj.append(new_obj)
-            #self.compress_force.append(force)
+        if not add:
+            self.compress_obj = []
+            self.compress_dup = []
+            self._dedup_thumb = None
+            self._series_threshold = None
+            self._series_computed = False
+            #self.compress_force = []
+        if (isinstance(compressed_path, basestring) and 
+            os.path.isdir(compressed_path)):
+            paths = _list_images(compressed_path)
         else:
-            self.compress_obj = [new_obj]
-            #self.compress_force = [force]
+            paths = [compressed_path]
+        self._get_background() # build once, before any workers start
+        pool = None
+        if self._workers > 1 and len(paths) > 1:
+            pool = ThreadPool(self._workers)
+        chunk_size = max(1, len(paths))
+        if self._measure_only: # bound the images in memory at a time
+            chunk_size = 2 * self._workers
+        try:
+            if self._prefetch and pool is None: # one image at a time
+                for path, img in prefetch_images(paths, self._prefetch):
+                    self._add_compressed_objects([path], images=[img])
+            else:
+                for i in range(0, len(paths), chunk_size):
+                    self._add_compressed_objects(paths[i : i+chunk_size], pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return True
+    
+    def set_measure_only(self, enabled=True):
+        '''
+        Sets whether compressed object images are kept after segmentation. 
+        In measure-only mode, each compressed SegmentedObject releases its 
+        images and masks as soon as it is measured, keeping only its contour
+        and measurements (see SegmentedObject.release()), so that thousands 
+        of images fit in memory. Images that were already loaded are released
+        immediately.
+        
+        The dimensions and size tables are unaffected, but the compressed
+        object segments can no longer be exported.
+        
+        Args:
+            enabled: whether to release compressed object images.
+        '''
+        
+        self._measure_only = enabled
+        if enabled:
+            for obj in self.compress_obj:
+                obj.release()
+        return
+    
+    def set_prefetch(self, depth=1):
+        '''
+        Sets how many compressed object images are read and decoded ahead, on
+        a background thread, while the current image is segmented (see 
+        obj_detect.prefetch_images()). This applies where images are 
+        segmented one at a time: with a single worker thread, or with 
+        tracking. Otherwise, the worker threads already overlap loading
+        and segmenting.
+        
+        Args:
+            depth: number of images to load ahead, or 0 to load each image
+                   only when it is segmented.
+        Returns:
+            True if the prefetch depth is valid and set; false otherwise.
+        '''
+        
+        if depth < 0:
+            return False
+        self._prefetch = depth
         return True
     
     def set_compressed_roi(self, x, y, w, h, xy_type="absolute", 
@@ -569,16 +918,276 @@ class BaxterObject(object):
         if not self.compress_obj:
             return False
         rect = self._get_roi(self.compress_obj[0], x, y, w, h, xy_type, dim_type)
+        if rect is None:
+            return False
+        self._compress_rect = rect
         for obj in self.compress_obj:
             obj.set_rectangle(*rect)
+            obj.reset_search_rectangle() # tracking windows of the old region
         return True  
+    
+    def set_compressed_tracking(self, enabled=True, margin=20):
+        '''
+        Enables or disables tracking of the compressed target object across
+        consecutive compressed object images. When enabled, each newly added 
+        image only searches for the object's contour within the previous 
+        image's upright bounding rectangle, expanded by a margin on all sides 
+        (and clipped to the compressed object region of interest, if set; 
+        see SegmentedObject.set_search_rectangle()). If the object is 
+        lost--nothing is found, or it reaches the edge of the search window--
+        the search falls back to the region of interest or the whole image.
+        
+        The masks and threshold are still computed over the region of 
+        interest (so a "roi" threshold is the same as without tracking), 
+        so tracking only saves work in the contour extraction, and keeps 
+        other foreground areas from being taken for the object.
+        
+        Tracking only affects images added after it is enabled, and changing
+        the region of interest ends it for the images loaded before.
+        
+        Args:
+            enabled: whether to track the object between images.
+            margin: pixel margin to add around the previous bounding rectangle.
+        Returns:
+            True if tracking settings are valid and set; false otherwise.
+        '''
+        
+        if not enabled:
+            self._track_margin = None
+            return True
+        if margin < 0:
+            return False
+        self._track_margin = margin
+        return True
+
+    def set_segment_method(self, method):
+        '''
+        Sets the foreground segmentation method used for object images loaded
+        afterwards (see SegmentedObject.set_fg_mask_method() for the methods).
+        The "simple-gray" method is the fastest, since the background is 
+        converted to grayscale once and each foreground image is filtered in
+        one channel only.
+        
+        Args:
+            method: name of the segmentation method.
+        Returns:
+            True if a supported method was given and set; false otherwise.
+        '''
+        
+        if not method.lower() in SEGMENT_METHODS:
+            return False
+        self._method = method.lower()
+        return True
+    
+    def set_cleanup(self, operation=None, size=3):
+        '''
+        Sets the morphological cleanup of foreground masks, which removes 
+        speckle noise before contour extraction, for all current and future 
+        object images (see SegmentedObject.set_cleanup() for the operations).
+        
+        Args:
+            operation: "open", "close", "open-close", or None to disable 
+                       cleanup.
+            size: pixel diameter of the cleanup kernel.
+        Returns:
+            True if valid cleanup settings were given and set; false otherwise.
+        '''
+        
+        if not operation is None:
+            if not operation in ("open", "close", "open-close") or size < 1:
+                return False
+            self._cleanup = (operation, size)
+        else:
+            self._cleanup = None
+        for obj in [self.measure_obj, self.box_obj, self.uncompress_obj, 
+                    self.arm_obj] + self.compress_obj:
+            if not obj is None:
+                obj.set_cleanup(operation, size)
+        return True
+    
+    def set_compressed_threshold(self, threshold=None, series=False):
+        '''
+        Sets how the compressed object images loaded afterwards are 
+        thresholded by the "simple" segmentation methods (see 
+        SegmentedObject.set_threshold()). With "roi", Otsu's method only 
+        considers pixels inside the compressed object region of interest and 
+        outside the arm color range, rather than the whole image.
+        
+        The threshold can also be computed once, for the first compressed 
+        image, and reused for the rest of the series. This saves computing 
+        a histogram per image, and keeps the threshold stable. If the first
+        image has no single threshold value (the "mog" methods, or a
+        background model with a per-pixel threshold), every image is 
+        thresholded as without series.
+        
+        The compressed object images that are already loaded are 
+        re-thresholded too, each when next used (see 
+        SegmentedObject.set_threshold()); released images keep theirs. With
+        series, the first loaded image is re-thresholded right away, and its
+        threshold is given to the others.
+        
+        Args:
+            threshold: None, "roi", or a fixed threshold from 0 to 255.
+            series: whether to reuse the first image's threshold for all 
+                    later compressed images.
+        Returns:
+            True if valid threshold settings were given and set; false 
+            otherwise.
+        '''
+        
+        if not (threshold is None or threshold == "roi" or 
+                0 <= threshold <= 255):
+            return False
+        self._compress_threshold = threshold
+        self._threshold_series = series
+        self._series_threshold = None
+        self._series_computed = False
+        if not series:
+            for obj in self.compress_obj:
+                obj.set_threshold(threshold)
+        elif self.compress_obj and not self.compress_obj[0].fg_img is None:
+            first = self.compress_obj[0]
+            first.set_threshold(threshold)
+            first.measure() # computes its threshold value
+            self._series_threshold = first.threshold_value
+            self._series_computed = True
+            if not self._series_threshold is None:
+                threshold = self._series_threshold
+            for obj in self.compress_obj[1:]:
+                obj.set_threshold(threshold)
+        return True
+    
+    def set_compressed_dedup(self, enabled=True, threshold=1.0):
+        '''
+        Enables or disables skipping near-duplicate compressed object images.
+        When enabled, each newly added image is first compared to the last 
+        fully processed image at thumbnail size; if their mean grayscale 
+        difference is below a threshold (e.g. the arm is holding still), the 
+        image is not segmented, and reuses the previous image's segmentation
+        instead. Such images are recorded in compress_dup.
+        
+        Args:
+            enabled: whether to skip near-duplicate images.
+            threshold: mean absolute grayscale difference (0 to 255) between
+                       thumbnails below which an image counts as a duplicate.
+        Returns:
+            True if deduplication settings are valid and set; false otherwise.
+        '''
+        
+        if not enabled:
+            self._dedup_threshold = None
+            return True
+        if threshold < 0:
+            return False
+        self._dedup_threshold = threshold
+        return True
+    
+    def set_camera_calibration(self, calibration_path, cache_dir=None):
+        '''
+        Sets a camera calibration to remove lens distortion from all images
+        with, as they are loaded, so that object sizes are not warped near
+        the image edges. The remap tables are computed once and cached on 
+        disk (see obj_detect.Undistorter). Compressed object images that are
+        only measured once (see iter_compressed_sizes()) are undistorted 
+        within the region of interest alone, if one is set; loaded ones are
+        undistorted whole, as their region of interest may still grow.
+        
+        The background model is rebuilt, but images that were already loaded
+        are not undistorted, so the calibration should be set first.
+        
+        Args:
+            calibration_path: file path to a NumPy .npz file with the arrays
+                              "camera_matrix" and "dist_coeffs", as computed 
+                              by cv2.calibrateCamera(), or None to ignore lens
+                              distortion again.
+            cache_dir: (optional) directory path to cache the remap tables 
+                       in. Defaults to the calibration file's directory.
+        Returns:
+            True if the calibration was set; false if it could not be read.
+        '''
+        
+        undistorter = None
+        if not calibration_path is None:
+            try:
+                undistorter = Undistorter(calibration_path, cache_dir)
+            except IOError:
+                return False
+        self._undistorter = undistorter
+        self._bg_model = None # rebuilt with the new calibration
+        return True
+    
+    def share_background(self):
+        '''
+        Copies the background model and the arm color range to shared memory,
+        for worker processes to segment compressed object images against 
+        without copying them (see obj_shared.measure_processes()). The 
+        compressed threshold (the series threshold, once computed), mask
+        cleanup, and camera calibration are passed along, so the workers 
+        segment the images as set_compressed_image() would.
+        
+        Returns:
+            A SharedBackground.
+        '''
+        
+        color_range = None
+        if not self._color_low is None and not self._color_high is None:
+            color_range = (self._color_low, self._color_high)
+        threshold = self._compress_threshold
+        if not self._series_threshold is None:
+            threshold = self._series_threshold
+        return SharedBackground(self._get_background(), color_range, 
+                                self._undistorter, threshold, self._cleanup)
+    
+    def prepare_background(self):
+        '''
+        Builds the background model (and its grayscale conversion, for the 
+        "simple-gray" method) now rather than for the first compressed object
+        image, e.g. before images are segmented from several threads at once
+        with measure_compressed_image().
+        
+        Returns:
+            The BackgroundModel.
+        '''
+        
+        bg_model = self._get_background()
+        if self._method == "simple-gray":
+            bg_model.get_gray()
+        return bg_model
+    
+    def set_thread_budget(self, workers=None, cv_threads=None):
+        '''
+        Sets the number of worker threads used to segment directories of 
+        compressed object images, together with the number of OpenCV threads,
+        which is global to the process (see obj_detect.set_thread_budget()).
+        
+        Args:
+            workers: (optional) number of worker threads. Defaults to the 
+                     number of cores.
+            cv_threads: (optional) number of OpenCV threads, shared by the 
+                        workers. Defaults to the cores divided by the 
+                        workers.
+        Returns:
+            A pair (workers, cv_threads) denoting the budget that was applied.
+        '''
+        
+        self._workers, cv_threads = set_thread_budget(workers, cv_threads)
+        return (self._workers, cv_threads)
+    
+    def get_workers(self):
+        '''
+        Returns the number of worker threads set with set_thread_budget().
+        '''
+        
+        return self._workers
 
     def get_mm_per_px(self):
-        if not self._measure_size is None:
-            return self._box_size
-        if self.measure_obj is None:
+        if not self._mm_per_px is None:
+            return self._mm_per_px
+        if self._measure_mm is None:
+            return -1
+        width_px, height_px = self.get_measure_size()
+        if width_px <= 0 or height_px <= 0: # segmentation failed
             return -1
-        width_px, height_px = self.measure_obj.get_object_rectangle_size(min_area=True)
         width_mm, height_mm = self._measure_mm
         return ((width_mm/width_px) + (height_mm/height_px)) / 2.0  
     
@@ -587,7 +1196,7 @@ class BaxterObject(object):
             return self._measure_size
         if self.measure_obj is None:
             return (-1, -1)
-        return self.measure_obj.get_object_rectangle_size(min_area) 
+        return self.measure_obj.measure().size(min_area) 
     
     def get_box_size(self, min_area=True):
         '''
@@ -605,7 +1214,7 @@ class BaxterObject(object):
             return self._box_size
         if self.box_obj is None:
             return (-1, -1)
-        return self.box_obj.get_object_rectangle_size(min_area) 
+        return self.box_obj.measure().size(min_area) 
     
     def get_uncompressed_size(self, min_area=True):
         '''
@@ -622,7 +1231,7 @@ class BaxterObject(object):
         
         if self.uncompress_obj is None:
             return (-1, -1)
-        return self.uncompress_obj.get_object_rectangle_size(min_area) 
+        return self.uncompress_obj.measure().size(min_area) 
     
     def get_compressed_size(self, min_area=True, all=False):
         '''
@@ -643,11 +1252,74 @@ class BaxterObject(object):
         
         if not self.compress_obj:
             return [(-1, -1)]
-        all_dim = [x.get_object_rectangle_size(min_area) for x in self.compress_obj]
+        all_dim = [x.measure().size(min_area) for x in self.compress_obj]
         if all:
             return all_dim
         return min(all_dim, key=(lambda x: x[0]*x[1]))
     
+    def measure_compressed_image(self, compressed_path):
+        '''
+        Segments a single compressed object image on its own, without adding
+        it to the compressed object images. The arm color range, compressed
+        object region of interest, segmentation method, threshold (the series
+        threshold, once computed), mask cleanup and camera calibration are 
+        applied as in set_compressed_image(), but deduplication and tracking
+        are not, and the image is dropped once measured. Several threads may
+        call it at once, after prepare_background().
+        
+        Args:
+            compressed_path: file path to compressed object image, an 
+                             ArchiveMember, or the already decoded image.
+        Returns:
+            An ObjectGeometry of the compressed target object.
+        Raises:
+            IOError: the image could not be read.
+        '''
+        
+        return self._new_compressed_object(compressed_path, True).measure()
+    
+    def iter_compressed_sizes(self, source, min_area=True, segment_dir=None,
+                              segment_video=None):
+        '''
+        Segments a series of compressed object images one at a time, yielding
+        the size of the compressed target object in each. Unlike 
+        set_compressed_image(), no SegmentedObject is kept: each image and its
+        masks are released as soon as the image has been measured, so memory
+        use does not grow with the length of the series.
+        
+        The arm color range, compressed object region of interest, tracking,
+        deduplication, and thread budget settings are applied as in 
+        set_compressed_image(). With more than one worker (and no tracking,
+        which needs each image's predecessor segmented first), the images 
+        run through a Pipeline: they are read by one thread, segmented by 
+        the workers, and their segments written by another, all overlapping,
+        with at most a few images in flight at a time.
+        
+        Args:
+            source: directory path of compressed object images (read in 
+                    alphabetical order), or an iterable of image file paths.
+            min_area: whether to calculate the object's dimension based
+                      on the minimum area bounding rectangle, instead of 
+                      an upright bounding rectangle.
+            segment_dir: (optional) directory path to write each image's 
+                         object segment to, named after the image.
+            segment_video: (optional) file path of a video to write each 
+                           image's object segment to as a frame, with its
+                           bounding rectangle drawn (see 
+                           export_compress_video()).
+        Returns:
+            A generator of FrameSize records (index, path, width, height,
+            duplicate).
+        '''
+        
+        if isinstance(source, basestring):
+            source = _list_images(source)
+        self._get_background() # build once, before any workers start
+        sink = _SegmentSink(segment_dir, segment_video)
+        if self._workers > 1 and self._track_margin is None:
+            return self._pipeline_compressed_sizes(source, min_area, sink)
+        return self._serial_compressed_sizes(source, min_area, sink)
+    
     def check_uncompressed_fit(self, min_area=True):
         '''
         Checks if the uncompressed target object 'fits' in the reference 
@@ -680,15 +1352,218 @@ class BaxterObject(object):
         
         return check_fit(self.get_compressed_size(min_area), self.get_box_size(min_area))
 
+    def _serial_compressed_sizes(self, source, min_area, sink):
+        prev_geometry = None
+        thumb = None
+        if self._prefetch:
+            loaded = prefetch_images(source, self._prefetch)
+        else:
+            loaded = ((path, None) for path in source)
+        try:
+            for index, (path, img) in enumerate(loaded):
+                images = None if img is None else [img]
+                objs, thumb = self._new_compressed_objects([path], None, thumb,
+                                                           images, True)
+                obj = objs[0]
+                if obj is None: # near-duplicate, reuse previous geometry
+                    sink.write(path, None)
+                    w, h = prev_geometry.size(min_area)
+                    yield FrameSize(index, path, w, h, True)
+                    continue
+                if not self._track_margin is None and not prev_geometry is None:
+                    self._track_object(obj, prev_geometry)
+                prev_geometry = obj.measure()
+                sink.write(path, obj)
+                w, h = prev_geometry.size(min_area)
+                yield FrameSize(index, path, w, h, False)
+                del objs, obj, img # release image and masks
+        finally:
+            loaded.close()
+            sink.close()
+        return
+    
+    def _pipeline_compressed_sizes(self, source, min_area, sink):
+        state = {"thumb": None} # of the last non-duplicate image
+        
+        def decode((index, path)): # one thread, so images arrive in order
+            img = load_image(path, "Foreground")
+            if not self._dedup_threshold is None:
+                new_thumb = thumbnail(img)
+                thumb = state["thumb"]
+                if (not thumb is None and self._dedup_threshold >
+                    np.mean(cv2.absdiff(new_thumb, thumb))):
+                    return (index, path, None)
+                state["thumb"] = new_thumb
+            if self._threshold_series and not self._series_computed:
+                obj = self._new_compressed_object(img, True) # others need it
+                self._series_threshold = obj.threshold_value
+                self._series_computed = True
+                return (index, path, obj)
+            return (index, path, img)
+        
+        def segment((index, path, src)):
+            if src is None:
+                return (index, path, None)
+            obj = src
+            if isinstance(src, np.ndarray):
+                obj = self._new_compressed_object(src, True)
+            obj.measure()
+            return (index, path, obj)
+        
+        # One thread, so the Pipeline passes the segments in image order (the
+        # video frames and repeated near-duplicates depend on it); drops the
+        # images
+        def write((index, path, obj)):
+            sink.write(path, obj)
+            return (index, path, None if obj is None else obj.measure())
+        
+        pipe = Pipeline(queue_size=self._workers)
+        pipe.add_stage("decode", decode)
+        pipe.add_stage("segment", segment, self._workers)
+        pipe.add_stage("write", write)
+        prev_geometry = None
+        try:
+            for index, path, geometry in pipe.run(enumerate(source)):
+                duplicate = geometry is None # reuse previous geometry
+                if not duplicate:
+                    prev_geometry = geometry
+                w, h = prev_geometry.size(min_area)
+                yield FrameSize(index, path, w, h, duplicate)
+        finally:
+            sink.close()
+        return
+    
+    def _add_compressed_objects(self, paths, pool=None, images=None):
+        new_objs, self._dedup_thumb = self._new_compressed_objects(
+            paths, pool, self._dedup_thumb, images)
+        for new_obj in new_objs: # tracking depends on the previous image
+            if new_obj is None: # near-duplicate, reuse previous segmentation
+                self.compress_obj[-1].measure() # so the copy shares it
+                self.compress_obj.append(copy.copy(self.compress_obj[-1]))
+                self.compress_dup.append(True)
+                continue
+            if not self._track_margin is None and self.compress_obj:
+                self._track_object(new_obj, self.compress_obj[-1].measure())
+            if self._measure_only:
+                new_obj.release()
+            self.compress_obj.append(new_obj)
+            self.compress_dup.append(False)
+            #self.compress_force.append(force)
+        return
+    
+    def _new_compressed_objects(self, paths, pool=None, thumb=None, 
+                                images=None, transient=False):
+        # Returns new compressed objects for the paths (or their already
+        # loaded images), with None in place of near-duplicates of the
+        # preceding image, and the thumbnail of the last non-duplicate image
+        # (initially thumb) to compare later ones to. Transient objects are
+        # dropped once measured (see _new_compressed_object()).
+        new_object = lambda src: self._new_compressed_object(src, transient)
+        sources = paths if images is None else images
+        if not self._dedup_threshold is None:
+            loaded = sources
+            sources = []
+            for src in loaded:
+                img = load_image(src, "Foreground")
+                new_thumb = thumbnail(img)
+                if (not thumb is None and self._dedup_threshold >
+                    np.mean(cv2.absdiff(new_thumb, thumb))):
+                    sources.append(None)
+                else:
+                    sources.append(img)
+                    thumb = new_thumb
+        unique = [src for src in sources if not src is None]
+        first = []
+        if unique and self._threshold_series and not self._series_computed:
+            first = [new_object(unique.pop(0))]
+            first[0].measure() # thresholds within its final rectangle
+            self._series_threshold = first[0].threshold_value
+            self._series_computed = True
+        if pool:
+            new_objs = iter(first + pool.map(new_object, unique))
+        else:
+            new_objs = itertools.chain(first, (new_object(src) 
+                                               for src in unique))
+        objs = [None if src is None else next(new_objs) for src in sources]
+        for path, obj in zip(paths, objs):
+            if not obj is None and isinstance(path, (basestring, ArchiveMember)):
+                obj.label = str(path) # even if decoded here
+                obj.source = path # for reloading later
+        return (objs, thumb)
+    
+    def _new_object(self, path):
+        new_obj = SegmentedObject(self._get_background(), path, self._method,
+                                  undistorter=self._undistorter)
+        if not self._cleanup is None:
+            new_obj.set_cleanup(*self._cleanup)
+        return new_obj
+    
+    def _new_compressed_object(self, compressed_path, transient=False):
+        # Only a transient object, measured once and dropped, has its image
+        # undistorted within the region of interest alone: enlarging the
+        # region of a kept object later (e.g. set_compressed_roi()) would 
+        # expose the background copied outside it
+        rect = self._compress_rect
+        if not transient and not self._undistorter is None:
+            rect = None
+        color_range = None
+        if not self._color_low is None and not self._color_high is None:
+            color_range = (self._color_low, self._color_high)
+        threshold = self._compress_threshold
+        if not self._series_threshold is None:
+            threshold = self._series_threshold
+        new_obj = SegmentedObject(self._get_background(), compressed_path, 
+                                  self._method, color_range, rect, threshold,
+                                  self._undistorter)
+        if rect is None and not self._compress_rect is None:
+            new_obj.set_rectangle(*self._compress_rect)
+        if not self._cleanup is None:
+            new_obj.set_cleanup(*self._cleanup)
+        return new_obj
+    
+    def _get_size_rows(self, stream=None):
+        mm_px = self.get_mm_per_px()
+        
+        w, h = self.get_measure_size()
+        yield ["reference-measure", w, h, 0, 0, w*mm_px, h*mm_px, 0, 0, 0]
+        w, h = self.get_box_size()
+        yield ["reference-box", w, h, 0, 0, w*mm_px, h*mm_px, 0, 0, 0]
+        
+        w, h = self.get_uncompressed_size()
+        yield ["uncompressed", w, h, 0, 0, w*mm_px, h*mm_px, 0, 0, 0]
+        if not stream is None:
+            compressed_sizes = ((r.width, r.height, r.duplicate) for r in stream)
+        elif self.compress_obj:
+            compressed_sizes = [size + (dup,) for size, dup in 
+                                zip(self.get_compressed_size(all=True), 
+                                    self.compress_dup)]
+        else:
+            return
+        for i, (w_c, h_c, dup) in enumerate(compressed_sizes):
+            w_chg = w_c - w
+            h_chg = h_c - h
+            yield ["compressed-"+str(i), w_c, h_c, w_chg, h_chg, 
+                   w_c*mm_px, h_c*mm_px, w_chg*mm_px, h_chg*mm_px, int(dup)]
+        return
+    
+    def _get_background(self):
+        if self._bg_model_paths is None or self._bg_model_paths[0] != self.bg_path:
+            self._bg_model = None
+            self._bg_model_paths = [self.bg_path]
+        if self._bg_model is None:
+            self._bg_model = BackgroundModel(self._bg_model_paths, 
+                                             undistorter=self._undistorter)
+        return self._bg_model
+    
     def _update_arm_color(self):
-        arm_area = self.arm_obj.get_object_mask()
-        arm_hsv = cv2.cvtColor(self.arm_obj.fg_img, cv2.COLOR_BGR2HSV)
+        arm_hsv = self.arm_obj.get_foreground_hsv() # kept for later ROIs
+        arm_area = self.arm_obj.get_object_mask()[self.arm_obj._get_window()]
         tolerances = self._color_tol
         channels = [[0], [1], [2]]
         bins = [180, 256, 256]
         ranges = [[0,179], [0,255], [0,255]]
-        self._color_low = []
-        self._color_high = []
+        color_low = []
+        color_high = []
         for i in range(3):
             hist = cv2.calcHist([arm_hsv], channels[i], arm_area, [bins[i]], ranges[i])
             densities = []
@@ -702,16 +1577,62 @@ class BaxterObject(object):
                     continue
                 densities.append(freq)
             min_value = np.argmax(densities)
-            self._color_low.append(min_value)
-            self._color_high.append((min_value + tolerances[i]) % (bins[i] + 1))
+            color_low.append(min_value)
+            color_high.append((min_value + tolerances[i]) % (bins[i] + 1))
             # Debug
             #np.set_printoptions(suppress=True)
             #print hist
             #print densities
+        self._set_color_range(color_low, color_high)
         return
     
+    def _set_color_range(self, color_low, color_high):
+        # Only marks the loaded compressed objects' color masks for 
+        # recomputation, so re-tuning the arm color is instant however
+        # many images are loaded
+        if (not self._color_low is None and not self._color_high is None and
+            list(color_low) == list(self._color_low) and 
+            list(color_high) == list(self._color_high)):
+            return
+        self._color_low = color_low
+        self._color_high = color_high
+        for obj in self.compress_obj:
+            obj.set_ignore_color(color_low, color_high)
+        return
+    
+    def _track_object(self, obj, prev_geometry):
+        p1, __, p3, __ = prev_geometry.rect_points
+        if p1 == p3: # object lost in previous image
+            return False
+        height, width = obj.fg_img.shape[:2]
+        if self._compress_rect is None:
+            fx, fy, fw, fh = (0, 0, width, height)
+        else:
+            fx, fy, fw, fh = self._compress_rect
+        m = self._track_margin
+        x = max(p1[0] - m, fx)
+        y = max(p1[1] - m, fy)
+        w = min(p3[0] + m, fx + fw) - x
+        h = min(p3[1] + m, fy + fh) - y
+        if w <= 0 or h <= 0:
+            return False
+        
+        obj.set_search_rectangle(x, y, w, h)
+        q1, __, q3, __ = obj.measure().rect_points
+        lost = (q1 == q3 or (q1[0] <= x and x > fx) or (q1[1] <= y and y > fy) 
+                or (q3[0] >= x+w and x+w < fx+fw) 
+                or (q3[1] >= y+h and y+h < fy+fh))
+        if lost: # search the whole region of interest instead
+            obj.reset_search_rectangle()
+            return False
+        return True
+    
     def _get_roi(self, ref_obj, x, y, w, h, xy_type, dim_type):
-        height, width, __ = ref_obj.fg_img.shape
+        # Uses the size recorded at load, as the image may be released
+        size = getattr(ref_obj, "image_size", None)
+        if size is None:
+            return None
+        width, height = size
         if xy_type.lower() == "relative":
             x = min(max(0, x*width / 100), width)
             y = min(max(0, y*height / 100), height)
@@ -722,6 +1643,136 @@ class BaxterObject(object):
             return (x , y, width, height) 
         return (x, y, w, h)
     
+def _profile_values(profile, key, length, cast):
+    '''
+    Helper function reading a list of numbers from a calibration profile, 
+    as a tuple, or None if it is missing. Not to be used by user.
+    
+    Raises:
+        ValueError: the value is not a list of length numbers.
+        TypeError: the value is not a list.
+    '''
+    
+    values = profile.get(key)
+    if values is None:
+        return None
+    if len(values) != length:
+        raise ValueError("Expected %d values for %s." % (length, key))
+    return tuple(cast(_check_number(v, key)) for v in values)
+
+def _profile_number(profile, key):
+    '''
+    Helper function reading a number from a calibration profile. Not to be
+    used by user.
+    
+    Raises:
+        KeyError: the value is missing.
+        ValueError: the value is not a number.
+    '''
+    
+    return _check_number(profile[key], key)
+
+def _check_number(value, key):
+    '''
+    Helper function returning a calibration profile value if it is a number
+    (JSON true and false are not, though Python treats them as 0 and 1). 
+    Not to be used by user.
+    
+    Raises:
+        ValueError: the value is not a number.
+    '''
+    
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        raise ValueError("Expected a number for %s." % key)
+    return value
+
+def _list_images(path_dir):
+    '''
+    Helper function listing the PNG and JPG images of a directory, in 
+    alphabetical order. Not to be used by user.
+    '''
+    
+    return [os.path.join(path_dir, file) for file in sorted(os.listdir(path_dir))
+            if file.endswith(".png") or file.endswith(".jpg")]
+
+class _SegmentSink(object):
+    '''
+    Helper class writing the object segments of a series of compressed 
+    object images, in order, as image files and/or the frames of a video.
+    Not to be used by user.
+    '''
+    
+    def __init__(self, segment_dir=None, video_path=None, fps=10.0, 
+                 codec="MJPG"):
+        self.segment_dir = segment_dir
+        self.video_path = video_path
+        self.fps = fps
+        self.codec = codec
+        self.frames = 0
+        self._video = None # opened with the first frame's dimensions
+        self._last = None # last frame, repeated for near-duplicates
+        return
+    
+    def write(self, path, obj):
+        if obj is None: # near-duplicate of the previous image
+            if not self._video is None:
+                self._video.write(self._last)
+                self.frames += 1
+            return
+        if not self.segment_dir is None:
+            name = os.path.splitext(os.path.basename(str(path)))[0]
+            obj.export_object_segment(os.path.join(self.segment_dir, 
+                                                   name + "_seg.png"))
+        if not self.video_path is None:
+            self._last = obj.get_object_segment(True)
+            if self._video is None:
+                height, width = self._last.shape[:2]
+                self._video = open_video(self.video_path, (width, height), 
+                                         self.fps, self.codec)
+            with stage("export", self.video_path):
+                self._video.write(self._last)
+            self.frames += 1
+        return
+    
+    def close(self):
+        if not self._video is None:
+            self._video.release()
+            self._video = None
+        return
+
+def load_sizes_npz(paths):
+    '''
+    Reads size tables written by BaxterObject.export_sizes_npz() from one or
+    more experiments, and concatenates them column by column.
+    
+    Args:
+        paths: file path, or list of file paths, to .npz size tables.
+    Returns:
+        A dictionary mapping each column name ("object", "duplicate", and 
+        those in SIZE_COLUMNS) to an array holding the rows of all experiments, plus
+        "experiment", an array of the index in paths each row came from, and
+        "mm_per_px", an array of each experiment's conversion factor.
+    '''
+    
+    if isinstance(paths, basestring):
+        paths = [paths]
+    names = ("object", "duplicate") + SIZE_COLUMNS
+    parts = dict((name, []) for name in names)
+    experiment = []
+    mm_per_px = []
+    for i, path in enumerate(paths):
+        with np.load(path) as data:
+            for name in names:
+                parts[name].append(data[name])
+            experiment.append(np.repeat(i, len(data["object"])))
+            mm_per_px.append(float(data["mm_per_px"]))
+    sizes = dict((name, np.concatenate(parts[name]) if paths else np.array([]))
+                 for name in names)
+    sizes["experiment"] = (np.concatenate(experiment) if paths 
+                           else np.array([], np.int64))
+    sizes["mm_per_px"] = np.array(mm_per_px)
+    return sizes
+
 # Old test script for BaxterObject
 # def main():
     # Test arm color subtraction
@@ -5,10 +5,370 @@ Created on Feb 28, 2014
 '''
 
 import argparse
+import csv
+import glob
+import json
+import multiprocessing
 import numpy as np
 import cv2
 import os
+import struct
+import sys
+import tarfile
+import zipfile
 from math import sqrt, hypot
+import profiling
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from pipeline import Pipeline
+from profiling import stage
+
+# Segmentation methods of SegmentedObject.set_fg_mask_method()
+SEGMENT_METHODS = ("simple", "simple-gray", "mog", "mog2")
+
+# Morphological cleanup operations of SegmentedObject.set_cleanup()
+CLEANUP_OPERATIONS = ("open", "close", "open-close")
+
+class BackgroundModel(object):
+    '''
+    A BackgroundModel represents the background of a scene, built once from
+    one or more background images, and shared by every SegmentedObject
+    segmented against it.
+    
+    With a single background image, the model is just that image after noise 
+    filtering. With several, the model is the per-pixel median of the images,
+    along with a per-pixel estimate of sensor noise, which is used to threshold
+    foreground differences instead of filtering every foreground image.
+    
+    Attributes:
+        img: Background image, either filtered or the per-pixel median.
+        noise: Per-pixel standard deviation estimate of grayscale intensity,
+               or None if built from a single image.
+        thresh: Per-pixel grayscale difference above which a pixel is 
+                considered foreground, or None if built from a single image.
+    '''
+    
+    _gray = None # grayscale img, converted when first needed
+    
+    def __init__(self, bg_paths, noise_factor=3.0, min_thresh=10, 
+                 undistorter=None):
+        '''
+        Initiates BackgroundModel with user-specified background image paths.
+        
+        Args:
+            bg_paths: file path, or list of file paths, to background images. 
+                      All images must have the same dimensions.
+            noise_factor: (optional) number of noise standard deviations a
+                          pixel must differ by to be considered foreground.
+            min_thresh: (optional) minimum grayscale difference for a pixel
+                        to be considered foreground.
+            undistorter: (optional) Undistorter to remove lens distortion 
+                         from the images with, right after loading.
+        '''
+        
+        if isinstance(bg_paths, (basestring, ArchiveMember)):
+            bg_paths = [bg_paths]
+        frames = []
+        for path in bg_paths:
+            with stage("load", str(path)):
+                img = load_image(path, "Background")
+                if not undistorter is None:
+                    img = undistorter.undistort(img)
+            if frames and img.shape != frames[0].shape:
+                raise ValueError("Background images differ in size.")
+            frames.append(img)
+        if not frames:
+            raise ValueError("No background images given.")
+        
+        if len(frames) == 1:
+            # Blurring images smooths out noise 
+            with stage("filter", str(bg_paths[0])):
+                self.img = cv2.bilateralFilter(frames[0], 5, 100, 100)
+            self.noise = None
+            self.thresh = None
+            return
+        with stage("filter", str(bg_paths[0])):
+            self._build_median(frames, noise_factor, min_thresh)
+        return
+    
+    def _build_median(self, frames, noise_factor, min_thresh):
+        self.img = np.median(np.array(frames), axis=0).astype(np.uint8)
+        gray = np.array([cv2.cvtColor(f, cv2.COLOR_BGR2GRAY) for f in frames],
+                        np.float32)
+        deviation = np.abs(gray - np.median(gray, axis=0))
+        self.noise = 1.4826 * np.median(deviation, axis=0) # MAD to std. dev.
+        thresh = np.maximum(noise_factor * self.noise, min_thresh)
+        self.thresh = np.uint8(np.minimum(thresh, 255))
+        return
+    
+    def scaled(self, size):
+        '''
+        Returns a copy of the model resized to other dimensions, e.g. to 
+        segment previews of reduced resolution against.
+        
+        Args:
+            size: pair (width, height) of the new dimensions.
+        Returns:
+            The resized BackgroundModel.
+        '''
+        
+        model = BackgroundModel.__new__(BackgroundModel)
+        model.img = cv2.resize(self.img, size, interpolation=cv2.INTER_AREA)
+        model.noise = None
+        model.thresh = None
+        if not self.noise is None:
+            model.noise = cv2.resize(self.noise, size, 
+                                     interpolation=cv2.INTER_AREA)
+            model.thresh = cv2.resize(self.thresh, size, 
+                                      interpolation=cv2.INTER_AREA)
+        return model
+    
+    def get_gray(self):
+        '''
+        Returns the background image in grayscale. It is converted once, on
+        the first call, and cached for every SegmentedObject sharing the
+        model.
+        
+        Returns:
+            The grayscale background image.
+        '''
+        
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+class Undistorter(object):
+    '''
+    An Undistorter removes lens distortion from images, so that sizes near
+    the image edges are not warped, e.g. with wide-angle lenses. It reads a
+    camera calibration, as computed by cv2.calibrateCamera(), and computes
+    the remap tables for each image size once, caching them on disk.
+    
+    Attributes:
+        camera_matrix: 3x3 camera matrix of the calibration.
+        dist_coeffs: distortion coefficients of the calibration.
+    '''
+    
+    def __init__(self, calibration_path, cache_dir=None):
+        '''
+        Initiates Undistorter with a user-specified camera calibration.
+        
+        Args:
+            calibration_path: file path to a NumPy .npz file with the arrays
+                              "camera_matrix" and "dist_coeffs".
+            cache_dir: (optional) directory path to cache the remap tables 
+                       in. Defaults to the calibration file's directory.
+        Raises:
+            IOError: the calibration could not be read.
+        '''
+        
+        try:
+            with np.load(calibration_path) as calibration:
+                self.camera_matrix = calibration["camera_matrix"]
+                self.dist_coeffs = calibration["dist_coeffs"]
+        except (IOError, KeyError) as e:
+            raise IOError("Camera calibration not loaded successfully: " + 
+                          str(e))
+        if cache_dir is None:
+            cache_dir = os.path.dirname(os.path.abspath(calibration_path))
+        name = os.path.splitext(os.path.basename(calibration_path))[0]
+        self._cache_prefix = os.path.join(cache_dir, name)
+        self._maps = {} # (width, height) -> remap tables
+        return
+    
+    def undistort(self, img, rect=None, fill=None):
+        '''
+        Removes lens distortion from an image. The remapping can be limited
+        to a rectangle region of interest, which is much faster for small
+        regions; the rest of the image is then taken from a fill image (e.g.
+        the background, so it never differs from it), or left black.
+        
+        Args:
+            img: image matrix.
+            rect: (optional) 4-tuple (x, y, width, height) of the region to
+                  undistort.
+            fill: (optional) image matrix of the same dimensions as img, to
+                  take the pixels outside the region from.
+        Returns:
+            The undistorted image matrix.
+        '''
+        
+        height, width = img.shape[:2]
+        map1, map2 = self.get_maps((width, height))
+        if rect is None:
+            return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+        x, y, w, h = rect
+        x, y = max(0, x), max(0, y)
+        w, h = min(w, width - x), min(h, height - y)
+        out = np.zeros_like(img) if fill is None else fill.copy()
+        if w > 0 and h > 0:
+            out[y:y+h, x:x+w] = cv2.remap(img, map1[y:y+h, x:x+w], 
+                                          map2[y:y+h, x:x+w], cv2.INTER_LINEAR)
+        return out
+    
+    def get_maps(self, size):
+        '''
+        Returns the remap tables for an image size, as computed by 
+        cv2.initUndistortRectifyMap(). They are loaded from the cache file if
+        it was computed with the same calibration, and otherwise computed and
+        written to it.
+        
+        Args:
+            size: pair (width, height) of the image dimensions.
+        Returns:
+            A pair of remap tables, for cv2.remap().
+        '''
+        
+        size = tuple(size)
+        if size in self._maps:
+            return self._maps[size]
+        cache_path = self._cache_prefix + "-maps-%dx%d.npz" % size
+        maps = None
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as cache:
+                if (np.array_equal(cache["camera_matrix"], self.camera_matrix) 
+                    and np.array_equal(cache["dist_coeffs"], self.dist_coeffs)):
+                    maps = (cache["map1"], cache["map2"])
+        if maps is None:
+            maps = cv2.initUndistortRectifyMap(self.camera_matrix, 
+                self.dist_coeffs, None, self.camera_matrix, size, cv2.CV_16SC2)
+            try:
+                with open(cache_path, 'wb') as f:
+                    np.savez(f, map1=maps[0], map2=maps[1],
+                             camera_matrix=self.camera_matrix,
+                             dist_coeffs=self.dist_coeffs)
+            except IOError: # caching is only an optimization
+                pass
+        self._maps[size] = maps
+        return maps
+
+class ObjectGeometry(object):
+    '''
+    An ObjectGeometry holds the measurements of a segmented object, all 
+    derived from a single contour extraction. If no object was found, the
+    contour is None and all measurements are zero.
+    
+    Attributes:
+        contour: Array of points of the object's (largest) contour.
+        rect_points: 4-tuple of corner coordinates of the upright bounding
+                     rectangle.
+        rect_size: Pair (w,h) of the upright bounding rectangle's dimensions.
+        min_rect: The minimum area bounding rectangle, as returned by
+                  cv2.minAreaRect(): ((center x, center y), (w, h), angle).
+        min_rect_points: 4-tuple of corner coordinates of the minimum area
+                         bounding rectangle.
+        min_rect_size: Pair (w,h) of the minimum area bounding rectangle's 
+                       dimensions, with the width corresponding to the axis 
+                       closest to x (unlike the dimensions in min_rect).
+        contour_area: Area enclosed by the contour.
+        hull_area: Area of the contour's convex hull.
+        centroid: Pair (x,y) of the contour's center of mass.
+        contour_count: Number of contours the extraction found, of which the
+                       object's is the largest (e.g. to gauge mask noise).
+    '''
+    
+    __slots__ = ("contour", "rect_points", "rect_size", "min_rect", 
+                 "min_rect_points", "min_rect_size", "contour_area", 
+                 "hull_area", "centroid", "contour_count")
+    
+    def __init__(self, contour=None, contour_count=None):
+        '''
+        Initiates ObjectGeometry by measuring a contour.
+        
+        Args:
+            contour: (optional) array of contour points, as returned by
+                     cv2.findContours(). None denotes no object.
+            contour_count: (optional) number of contours extracted along 
+                           with it. Defaults to 1, or 0 without a contour.
+        '''
+        
+        self.contour = contour
+        if contour_count is None:
+            contour_count = 0 if contour is None else 1
+        self.contour_count = contour_count
+        if contour is None:
+            zeros = ((0,0), (0,0), (0,0), (0,0))
+            self.rect_points = zeros
+            self.rect_size = (0.0, 0.0)
+            self.min_rect = ((0.0, 0.0), (0.0, 0.0), 0.0)
+            self.min_rect_points = zeros
+            self.min_rect_size = (0.0, 0.0)
+            self.contour_area = 0.0
+            self.hull_area = 0.0
+            self.centroid = (0.0, 0.0)
+            return
+        x, y, w, h = cv2.boundingRect(contour)
+        self.rect_points = ((x,y), (x+w,y), (x+w,y+h), (x,y+h))
+        self.rect_size = _rectangle_size(self.rect_points)
+        self.min_rect = cv2.minAreaRect(contour)
+        self.min_rect_points = cv2.cv.BoxPoints(self.min_rect)
+        self.min_rect_size = _rectangle_size(self.min_rect_points)
+        self.contour_area = cv2.contourArea(contour)
+        self.hull_area = cv2.contourArea(cv2.convexHull(contour))
+        moments = cv2.moments(contour)
+        if moments["m00"] != 0:
+            self.centroid = (moments["m10"] / moments["m00"], 
+                             moments["m01"] / moments["m00"])
+        else: # degenerate contour, e.g. a line
+            self.centroid = tuple(np.mean(contour.reshape(-1, 2), axis=0))
+        return
+    
+    def __getstate__(self):
+        return [getattr(self, name) for name in self.__slots__]
+    
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+        return
+    
+    def size(self, min_area=False):
+        '''
+        Returns the width and height of a bounding rectangle of the object.
+        
+        Args:
+            min_area: whether to use the minimum area bounding rectangle
+                      instead of the upright bounding rectangle.
+        Returns:
+            A tuple (w,h) of the pixel width and height of the rectangle.
+        '''
+        
+        return self.min_rect_size if min_area else self.rect_size
+    
+    def points(self, min_area=False):
+        '''
+        Returns the corners of a bounding rectangle of the object.
+        
+        Args:
+            min_area: whether to use the minimum area bounding rectangle
+                      instead of the upright bounding rectangle.
+        Returns:
+            A 4-tuple of pairs representing the rectangle corner coordinates.
+        '''
+        
+        return self.min_rect_points if min_area else self.rect_points
+    
+    def as_dict(self):
+        '''
+        Returns the measurements of the object (all but the contour) as plain
+        lists and floats, e.g. for JSON serialization.
+        
+        Returns:
+            A dict with keys "found", "rect_points", "rect_size", 
+            "min_rect_points", "min_rect_size", "contour_area", "hull_area",
+            "centroid", and "contour_count".
+        '''
+        
+        def floats(values):
+            return [float(v) for v in values]
+        return {"found": not self.contour is None,
+                "rect_points": [floats(p) for p in self.rect_points],
+                "rect_size": floats(self.rect_size),
+                "min_rect_points": [floats(p) for p in self.min_rect_points],
+                "min_rect_size": floats(self.min_rect_size),
+                "contour_area": float(self.contour_area),
+                "hull_area": float(self.hull_area),
+                "centroid": floats(self.centroid),
+                "contour_count": int(self.contour_count)}
 
 class SegmentedObject(object):
     '''
@@ -16,11 +376,32 @@ class SegmentedObject(object):
     based on a reference background image.
     
     Attributes:
+        label: Name of the foreground image (its file path, if it was loaded
+               from one), used e.g. in stage timings.
+        source: File path or ArchiveMember the foreground image was loaded
+                from, to reload it by (e.g. after release()), or None if it
+                was given decoded.
+        bg_model: BackgroundModel the object is segmented against.
         bg_img: Background image that does not contain object.
         fg_img: Foreground image of the same area as bg_img, but containing
                 the object for detection.
+        image_size: Pair (width, height) of fg_img, kept after release().
+        fg_filtered: Whether fg_img was filtered in color (by the "simple" 
+                     method, or before it was given).
+        fg_gray: Filtered grayscale foreground image, used by the 
+                 "simple-gray" method (None otherwise).
         fg_mask: Foreground mask, with white pixels representing hypothesized 
                  foreground and black pixels representing definite background.
+        diff_img: Grayscale difference between the background and foreground,
+                  used by the "simple" methods (None otherwise).
+        threshold: How diff_img is thresholded into fg_mask: None for Otsu's
+                   method over the whole image (or the background model's
+                   per-pixel noise threshold, if it has one), "roi" for Otsu's
+                   method over the region of interest only, or a fixed value.
+        threshold_value: The threshold value applied to diff_img, or None if 
+                         a per-pixel threshold or no threshold was applied.
+        color_range: 2-tuple (low, high) of the HSV color range ignored in
+                     color_mask, or None.
         color_mask: Foreground color mask, where black pixels represent areas 
                      to treat automatically as background. This can be used to 
                      prevent arms from being treated as part of the foreground 
@@ -28,46 +409,105 @@ class SegmentedObject(object):
         rect_mask: Foreground rectangle mask, where black pixels represent
                    areas to treat automatically as background. This can be used
                    to establish a region of focus.
+        rect: 4-tuple (x, y, width, height) of the rectangle in rect_mask, or
+              None if the whole image is considered. Contour extraction is
+              limited to this window.
+        search_rect: 4-tuple (x, y, width, height) of a rectangle further 
+                     limiting contour extraction (but not the masks or the
+                     threshold), e.g. to track an object between images, or
+                     None.
+        cleanup: Pair (operation, size) of the morphological cleanup applied
+                 to the masked foreground before contour extraction, or None.
     '''
     
     def __init__(self, bg_path, fg_path, method="simple", color_range=None,
-                 rectangle=None):
+                 rectangle=None, threshold=None, undistorter=None, 
+                 filtered=False):
         '''
         Initiates SegmentedObject with user-specified background and foreground
         image paths.
         
         Args:
-            bg_path: file path to background image.
-            fg_path: file path to foreground image.
+            bg_path: file path to background image, or a BackgroundModel to
+                     share with other SegmentedObjects.
+            fg_path: file path to foreground image, or the already decoded
+                     image.
             method: (optional) algorithm to use to create the foreground mask. 
             rectangle: (optional) 4-tuple representing the foreground rectangle
                        mask to use.
             color_range: (optional) 2-tuple representing the color range for
                          the foreground color mask.
+            threshold: (optional) thresholding of the "simple" methods; see
+                       set_threshold().
+            undistorter: (optional) Undistorter to remove lens distortion
+                         from the images with, when loading them (only 
+                         within the rectangle, if given; the rest is taken 
+                         from the background, so a rectangle enlarged later
+                         only finds background there; set it afterwards 
+                         instead if it may grow). A given BackgroundModel 
+                         should have been built with the same Undistorter.
+            filtered: (optional) whether the given foreground image was 
+                      already filtered in color (e.g. it is, or is scaled
+                      from, another SegmentedObject's fg_img with 
+                      fg_filtered set), so it is not filtered again.
+        Raises:
+            IOError: an image could not be read.
+            ValueError: the method is not supported (see 
+                        set_fg_mask_method()).
         '''
 
-        self.bg_img = cv2.imread(bg_path)
-        if self.bg_img is None:
-            raise IOError("Background image not loaded successfully.")
-        self.fg_img = cv2.imread(fg_path)
-        if self.fg_img is None:
-            raise IOError("Foreground image not loaded successfully.")
+        if isinstance(bg_path, BackgroundModel):
+            self.bg_model = bg_path
+        else:
+            self.bg_model = BackgroundModel(bg_path, undistorter=undistorter)
+        self.bg_img = self.bg_model.img
+        self.label = "<image>"
+        self.source = None
+        if isinstance(fg_path, (basestring, ArchiveMember)):
+            self.label = str(fg_path)
+            self.source = fg_path
+        with stage("load", self.label):
+            self.fg_img = load_image(fg_path, "Foreground")
+            if not undistorter is None:
+                self.fg_img = undistorter.undistort(self.fg_img, rectangle, 
+                                                    self.bg_img)
+        self.image_size = (self.fg_img.shape[1], self.fg_img.shape[0])
       
-        # Blurring images smooths out noise 
-        self.bg_img = cv2.bilateralFilter(self.bg_img, 5, 100, 100)
-        self.fg_img = cv2.bilateralFilter(self.fg_img, 5, 100, 100)
+        # Blurring images smooths out noise (unless the background model
+        # already accounts for it, or the image was given filtered)
+        self.fg_gray = None
+        self.fg_filtered = filtered
+        if method.lower() == "simple-gray": # only filter one channel
+            self._set_fg_gray()
+        elif self.bg_model.thresh is None and not self.fg_filtered:
+            self._filter_fg_img()
         #self.bg_img = cv2.medianBlur(self.bg_img, 9)
         #self.fg_img = cv2.medianBlur(self.fg_img, 9)
         
         # Initalizes masks
+        self._geometry = None # cached result of measure()
+        self.fg_mask = None
+        self.diff_img = None
+        self.threshold = threshold
+        self.threshold_value = None
+        self.cleanup = None
+        self._kernel = None
         white_mask = cv2.bitwise_not(np.zeros(self.fg_img.shape[:-1], np.uint8))
+        self.rect = None
         self.rect_mask = white_mask
+        self.search_rect = None
+        self.color_range = None
+        self.color_mask = white_mask
+        self._fg_hsv = None # (rect, HSV image of its window) for color_mask
+        self._rect_stale = False # masks to recompute before their next use
+        self._color_stale = False
+        self._threshold_stale = False
         if not rectangle is None:
             self.set_rectangle(*rectangle)
-        self.color_mask = white_mask
         if not color_range is None:
             self.set_ignore_color(*color_range)
-        self.set_fg_mask_method(method)
+        if not self.set_fg_mask_method(method):
+            raise ValueError("Unknown segmentation method: " + str(method))
         return
     
     def export_background(self, output_path):
@@ -79,7 +519,8 @@ class SegmentedObject(object):
             output_path: file path of output image.
         '''
         
-        cv2.imwrite(output_path, self.bg_img)
+        with stage("export", output_path):
+            cv2.imwrite(output_path, self.bg_img)
         return
     
     def export_foreground(self, output_path):
@@ -91,7 +532,8 @@ class SegmentedObject(object):
             output_path: file path of output image.
         '''
         
-        cv2.imwrite(output_path, self.fg_path)
+        with stage("export", output_path):
+            cv2.imwrite(output_path, self.fg_path)
         return
     
     def export_region_mask(self, output_path):
@@ -104,8 +546,9 @@ class SegmentedObject(object):
             output_path: file path of output image.
         '''
         
-        region_mask = cv2.bitwise_and(self.rect_mask, self.color_mask)
-        cv2.imwrite(output_path, region_mask)
+        region_mask = self.get_region_mask()
+        with stage("export", output_path):
+            cv2.imwrite(output_path, region_mask)
         return
     
     def export_region_segment(self, output_path):
@@ -117,9 +560,10 @@ class SegmentedObject(object):
             output_path: file path of output image.
         '''
         
-        region_mask = cv2.bitwise_and(self.rect_mask, self.color_mask)
+        region_mask = self.get_region_mask()
         segment = cv2.bitwise_and(self.fg_img, self.fg_img, mask=region_mask)
-        cv2.imwrite(output_path, segment)
+        with stage("export", output_path):
+            cv2.imwrite(output_path, segment)
         return
     
     def export_object_mask(self, output_path):
@@ -131,7 +575,8 @@ class SegmentedObject(object):
             output_path: file path of output image.
         '''
         
-        cv2.imwrite(output_path, self.get_object_mask())
+        with stage("export", output_path):
+            cv2.imwrite(output_path, self.get_object_mask())
         return
     
     def export_object_segment(self, output_path, draw_rectangle=False):
@@ -141,6 +586,23 @@ class SegmentedObject(object):
         
         Args:
             output_path: file path of output image.
+            draw_rectangle: whether to draw the upright bounding rectangle.
+        '''
+        
+        segment = self.get_object_segment(draw_rectangle)
+        with stage("export", output_path):
+            cv2.imwrite(output_path, segment)
+        return
+    
+    def get_object_segment(self, draw_rectangle=False):
+        '''
+        Applies the object mask of the SegmentedObject to its foreground image,
+        coloring areas not part of the object black.
+        
+        Args:
+            draw_rectangle: whether to draw the upright bounding rectangle.
+        Returns:
+            The segment image matrix.
         '''
         
         obj_mask = self.get_object_mask()
@@ -150,8 +612,7 @@ class SegmentedObject(object):
             white = [255, 255, 255]
             for i in range(4):
                 cv2.line(segment, points[i], points[(i+1)%4], white) 
-        cv2.imwrite(output_path, segment)
-        return
+        return segment
             
     def set_fg_mask_method(self, method):
         '''
@@ -160,13 +621,27 @@ class SegmentedObject(object):
         
         The following methods are supported:
         
-            - "simple": no-frills image difference and otsu thresholding.
+            - "simple": no-frills image difference and otsu thresholding
+                        (or per-pixel noise thresholding, if the background
+                        model was built from several images).
+            - "simple-gray": the same as "simple", but the foreground is 
+                             converted to grayscale before filtering and
+                             differencing, so both run on one channel instead
+                             of three. Faster, but differences in color alone
+                             (an object as bright as the background behind 
+                             it) are lost, which can shrink the segment.
+                             If given to the constructor, fg_img is left 
+                             unfiltered, so exports and the color mask use
+                             the unfiltered image (until "simple" is used).
+                             Otherwise, fg_gray is converted from the 
+                             already filtered fg_img, without filtering it
+                             a second time.
             - "mog": MOG background subtraction algorithm.
             - "mog2": MOG2 background subtraction algorithm.
         
         Args:
             method: The algorithm to use to create the foreground mask. Should
-                    be either "simple", "mog", or "mog2".
+                    be either "simple", "simple-gray", "mog", or "mog2".
         Returns:
             True if background and foreground images exist, a valid method
             was specified, and foreground segmentation was applied 
@@ -175,11 +650,30 @@ class SegmentedObject(object):
         
         if (self.bg_img is None) or (self.fg_img is None):
             return False
+        with stage("mask", self.label):
+            return self._set_fg_mask(method)
+    
+    def _set_fg_mask(self, method):
+        '''
+        Helper method for set_fg_mask_method(). Not to be used by user.
+        '''
+        
+        self._geometry = None
+        self.diff_img = None
+        self.threshold_value = None
+        self._threshold_stale = False
         if method.lower() == "simple":
-            self.fg_mask = cv2.absdiff(self.bg_img, self.fg_img)
-            self.fg_mask = cv2.cvtColor(self.fg_mask, cv2.COLOR_BGR2GRAY)
-            __, self.fg_mask = cv2.threshold(self.fg_mask, 0, 255,
-                                             cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+            if not self.fg_filtered and self.bg_model.thresh is None:
+                self._filter_fg_img() # built for "simple-gray"
+                self._fg_hsv = None
+                self._invalidate_region(color=not self.color_range is None)
+            diff = cv2.absdiff(self.bg_img, self.fg_img)
+            self._set_fg_mask_difference(cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY))
+        elif method.lower() == "simple-gray":
+            if self.fg_gray is None:
+                self._set_fg_gray()
+            diff = cv2.absdiff(self.bg_model.get_gray(), self.fg_gray)
+            self._set_fg_mask_difference(diff)
         elif method.lower() == "mog":
             bg_subtractor = cv2.BackgroundSubtractorMOG()
             bg_subtractor.apply(self.bg_img)
@@ -192,8 +686,6 @@ class SegmentedObject(object):
                                              cv2.THRESH_BINARY)
         else:
             return False
-    	#kernal = np.ones((7,7), np.uint8)
-    	#self.fg_mask = cv2.morphologyEx(self.fg_mask, cv2.MORPH_OPEN, kernal)
         return True
 
     def set_rectangle(self, x, y, width, height):
@@ -201,6 +693,10 @@ class SegmentedObject(object):
         Sets the foreground rectangle mask to all pixels within the bounds of a
         user-specified rectangle. 
         
+        The masks depending on the rectangle are only recomputed when next
+        used (e.g. by measure()), and not at all if the rectangle is 
+        unchanged.
+        
         Args:
             x: the x-value of the top-left pixel of the rectangle.
             y: the y-value of the top-left pixel of the rectangle.
@@ -213,9 +709,70 @@ class SegmentedObject(object):
         
         if self.fg_img is None:
             return False
-        self.rect_mask = np.zeros(self.fg_img.shape[:-1], np.uint8)
-        cv2.rectangle(self.rect_mask, (x,y), (x+width,y+height), 
-                      (255, 255, 255), cv2.cv.CV_FILLED)
+        if self.rect == (x, y, width, height):
+            return True # masks unchanged
+        self.rect = (x, y, width, height)
+        self._invalidate_region(rect=True)
+        return True
+    
+    def set_search_rectangle(self, x, y, width, height):
+        '''
+        Limits the search for the object's contour to the pixels within the 
+        bounds of a user-specified rectangle, e.g. around where it was found
+        in the previous image of a series. Unlike set_rectangle(), the masks
+        and the threshold (including a "roi" threshold) are unchanged, so 
+        only the contour extraction is narrowed; an object crossing the 
+        rectangle's edge is cut off there.
+        
+        Args:
+            x: the x-value of the top-left pixel of the rectangle.
+            y: the y-value of the top-left pixel of the rectangle.
+            width: total width of rectangle.
+            height: total height of rectangle.
+            
+        Returns:
+            True if search rectangle set successfully; false otherwise.
+        '''
+        
+        if self.fg_img is None:
+            return False
+        if self.search_rect != (x, y, width, height):
+            self.search_rect = (x, y, width, height)
+            self._geometry = None
+        return True
+    
+    def reset_search_rectangle(self):
+        '''
+        Removes the search rectangle, so that contours are extracted within
+        the whole rectangle mask again.
+        
+        Returns:
+            True if search rectangle reset successfully; false otherwise.
+        '''
+        
+        if self.fg_img is None:
+            return False
+        if not self.search_rect is None:
+            self.search_rect = None
+            self._geometry = None
+        return True
+    
+    def reset_rectangle(self):
+        '''
+        Removes the foreground rectangle mask, so that the whole image is
+        considered again.
+        
+        Returns:
+            True if foreground rectangle mask reset successfully; false 
+            otherwise.
+        '''
+        
+        if self.fg_img is None:
+            return False
+        if self.rect is None:
+            return True # masks unchanged
+        self.rect = None
+        self._invalidate_region(rect=True)
         return True
     
 
@@ -227,6 +784,12 @@ class SegmentedObject(object):
         Note the colors must be in HSV space; colors specified in other spaces 
         will have undefined results.
         
+        The mask is only computed when next used (e.g. by measure()), and 
+        only within the rectangle (plus a 1 pixel border), from an HSV 
+        conversion of the foreground image that is kept for later color 
+        ranges (see get_foreground_hsv()). Setting the same color range 
+        again does nothing.
+        
         Args:
             color_min: list of length 3 containing lower bound color values 
                        in HSV space to count as part of the ignore mask.
@@ -238,24 +801,196 @@ class SegmentedObject(object):
         
         if self.fg_img is None:
             return False
-        color_min = np.asarray(color_min)
-        color_max = np.asarray(color_max) 
-        fg_img_hsv = cv2.cvtColor(self.fg_img, cv2.COLOR_BGR2HSV)
+        color_range = (tuple(color_min), tuple(color_max))
+        if color_range == self.color_range:
+            return True # masks unchanged
+        self.color_range = color_range
+        self._invalidate_region(color=True)
+        return True
+    
+    def get_region_mask(self):
+        '''
+        Computes the region of interest of the SegmentedObject: the area of 
+        the image considered as possible foreground (in white), inside the 
+        rectangle and outside the ignored colors.
+        
+        Returns:
+            A matrix representing an 8-bit image mask.
+        '''
+        
+        return cv2.bitwise_and(self._get_rect_mask(), self._get_color_mask())
+    
+    def get_foreground_hsv(self):
+        '''
+        Returns the foreground image converted to HSV space, only within the
+        rectangle (plus a 1 pixel border) if one is set. The conversion is 
+        kept until the rectangle changes.
+        
+        Returns:
+            The HSV image matrix of the window.
+        '''
+        
+        if self._fg_hsv is None or self._fg_hsv[0] != self.rect:
+            window = self._get_window()
+            self._fg_hsv = (self.rect, cv2.cvtColor(self.fg_img[window], 
+                                                    cv2.COLOR_BGR2HSV))
+        return self._fg_hsv[1]
+    
+    def _invalidate_region(self, rect=False, color=False):
+        '''
+        Helper method marking the changed region of interest masks, and the
+        masks and measurements that depend on them, to be recomputed before
+        their next use. Not to be used by user.
+        '''
+        
+        self._geometry = None
+        if rect:
+            self._rect_stale = True
+            color = not self.color_range is None # computed within the window
+        if color:
+            self._color_stale = True
+        if self.threshold == "roi":
+            self._threshold_stale = True
+        return
+    
+    def _get_rect_mask(self):
+        '''
+        Helper method returning the rectangle mask, recomputed if the 
+        rectangle changed since. Not to be used by user.
+        '''
+        
+        if self._rect_stale:
+            self._rect_stale = False
+            self.rect_mask = np.zeros(self.fg_img.shape[:-1], np.uint8)
+            if self.rect is None:
+                self.rect_mask[:] = 255
+            else:
+                x, y, width, height = self.rect
+                cv2.rectangle(self.rect_mask, (x,y), (x+width,y+height), 
+                              (255, 255, 255), cv2.cv.CV_FILLED)
+        return self.rect_mask
+    
+    def _get_color_mask(self):
+        '''
+        Helper method returning the color ignore mask, recomputed if the 
+        color range or rectangle changed since. Not to be used by user.
+        '''
+        
+        if self._color_stale:
+            self._color_stale = False
+            self._set_color_mask()
+        return self.color_mask
+    
+    def _get_fg_mask(self):
+        '''
+        Helper method returning the foreground mask, re-thresholded if the
+        region of interest changed since (with "roi" thresholding). Not to be
+        used by user.
+        '''
+        
+        if self._threshold_stale:
+            self._apply_threshold()
+        return self.fg_mask
+    
+    def _set_color_mask(self):
+        '''
+        Helper method for computing the color ignore mask within the 
+        rectangle's window; outside it, nothing is ignored. Not to be used by
+        user.
+        '''
+        
+        fg_img_hsv = self.get_foreground_hsv()
+        color_min = np.asarray(self.color_range[0])
+        color_max = np.asarray(self.color_range[1])
         if color_min[0] > color_max[0]: # hue presumably "wraps" around
             color_min_upper = np.asarray([180, color_max[1], color_max[2]])
             color_max_lower = np.asarray([0, color_min[1], color_min[2]])
             mask_low = cv2.inRange(fg_img_hsv, color_max_lower, color_max)
             mask_high = cv2.inRange(fg_img_hsv, color_min, color_min_upper)
-            self.color_mask = cv2.bitwise_or(mask_low, mask_high)
+            color_mask = cv2.bitwise_or(mask_low, mask_high)
             # cv2.imshow("low", mask_low)
             # cv2.imshow("high", mask_high)
-            # cv2.imshow("both", self.color_mask)
+            # cv2.imshow("both", color_mask)
             # print color_max_lower, color_max
             # print color_min, color_min_upper
             # cv2.waitKey()
         else:
-            self.color_mask = cv2.inRange(fg_img_hsv, color_min, color_max)
-        self.color_mask = cv2.bitwise_not(self.color_mask)
+            color_mask = cv2.inRange(fg_img_hsv, color_min, color_max)
+        self.color_mask = cv2.bitwise_not(np.zeros(self.fg_img.shape[:-1], 
+                                                   np.uint8))
+        self.color_mask[self._get_window()] = cv2.bitwise_not(color_mask)
+        return
+    
+    def set_cleanup(self, operation=None, size=3):
+        '''
+        Sets a morphological cleanup of the foreground mask, applied (within
+        the rectangle's window) before contours are extracted. Speckle noise
+        in the mask otherwise produces many tiny contours, which are slow to
+        extract and measure. The following operations are supported:
+        
+            - "open": removes foreground specks smaller than the kernel.
+            - "close": fills background holes smaller than the kernel.
+            - "open-close": both, in that order.
+        
+        Args:
+            operation: name of the operation, or None to disable cleanup.
+            size: pixel diameter of the (elliptical) kernel.
+        Returns:
+            True if valid cleanup settings were given and set; false otherwise
+            (or if the object's images were released).
+        '''
+        
+        if self.fg_img is None:
+            return False
+        if operation is None:
+            self.cleanup = None
+            self._kernel = None
+            self._geometry = None
+            return True
+        if not operation in CLEANUP_OPERATIONS or size < 1:
+            return False
+        if self.cleanup == (operation, size):
+            return True # geometry unchanged
+        self.cleanup = (operation, size)
+        self._kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, 
+                                                 (size, size))
+        self._geometry = None
+        return True
+    
+    def set_threshold(self, threshold):
+        '''
+        Sets how the grayscale difference image of the "simple" methods is 
+        thresholded into the foreground mask. Like the region of interest 
+        masks, the mask (and threshold_value) is only recomputed when next 
+        used, e.g. by measure(). The following settings are supported:
+        
+            - None: Otsu's method over the whole difference image, or the
+                    background model's per-pixel noise threshold, if it has
+                    one.
+            - "roi": Otsu's method over the region of interest only (pixels
+                     inside the rectangle and outside the ignored colors), 
+                     which the rest of the image cannot bias. Only the 
+                     rectangle's window is thresholded. The mask is updated
+                     whenever the rectangle or ignored colors change. If 
+                     the ignored colors cover the whole rectangle, Otsu's 
+                     method uses the whole window instead.
+            - a number: that fixed threshold, e.g. one threshold_value 
+                        computed for another image of a series.
+        
+        Args:
+            threshold: None, "roi", or a number from 0 to 255.
+        Returns:
+            True if a "simple" method is in use and the threshold was set;
+            false otherwise.
+        '''
+        
+        if self.diff_img is None:
+            self.threshold = threshold
+            return False
+        if threshold != self.threshold:
+            self.threshold = threshold
+            self._geometry = None
+            self._threshold_stale = True
         return True
     
     def get_object_mask(self):
@@ -268,14 +1003,36 @@ class SegmentedObject(object):
             the object, and black pixels representing background.
         '''
         
-        contours = self._get_contours()
-        areas = [cv2.contourArea(c) for c in contours]
+        contour = self.measure().contour
         object_mask = np.zeros(self.fg_mask.shape, np.uint8)
-        if not areas:
+        if contour is None:
             return object_mask
-        cv2.drawContours(object_mask, contours, np.argmax(areas), 
-                         (255,255,255), cv2.cv.CV_FILLED)
+        cv2.drawContours(object_mask, [contour], 0, (255,255,255), 
+                         cv2.cv.CV_FILLED)
         return object_mask
+    
+    def measure(self):
+        '''
+        Extracts the foreground object's contour and computes all of its
+        measurements in one pass: upright and minimum area bounding 
+        rectangles, contour and convex hull areas, and centroid. The result
+        is cached until the masks or segmentation method change.
+        
+        Returns:
+            An ObjectGeometry of the foreground object.
+        '''
+        
+        if self._geometry is None:
+            with stage("contours", self.label):
+                contours = self._get_contours()
+                areas = [cv2.contourArea(c) for c in contours] if contours else []
+            with stage("geometry", self.label):
+                if not areas: # segmentation failed
+                    self._geometry = ObjectGeometry()
+                else:
+                    self._geometry = ObjectGeometry(contours[np.argmax(areas)],
+                                                    len(contours))
+        return self._geometry
         
     def get_object_rectangle_size(self, min_area=False):
         '''
@@ -292,15 +1049,7 @@ class SegmentedObject(object):
             rectangle.
         '''
         
-        p1, p2, __, p4 = self.get_object_rectangle_points(min_area)
-        d1 = hypot(p2[0] - p1[0], p2[1] - p1[1])
-        d2 = hypot(p4[0] - p1[0], p4[1] - p1[1])
-        if p2[0] - p1[0] != 0: # slope of d1 = infinity
-            s1 = float(p2[1] - p1[1]) / (p2[0] - p1[0])  
-            w, h = (d1, d2) if (-1 < s1 < 1) else (d2, d1)
-        else:
-            w, h = (d2, d1)
-        return (w, h)
+        return self.measure().size(min_area)
     
     def get_object_rectangle_points(self, min_area=False):
         '''
@@ -314,15 +1063,133 @@ class SegmentedObject(object):
             A 4-tuple of pairs representing the rectangle corner coordinates.
         '''
         
-        contours = self._get_contours()
-        areas = [cv2.contourArea(c) for c in contours]
-        if not areas: # segmentation failed
-            return ((0,0), (0,0), (0,0), (0,0))
-        if min_area:
-            min_rect = cv2.minAreaRect(contours[np.argmax(areas)])
-            return cv2.cv.BoxPoints(min_rect)
-        x, y, w, h = cv2.boundingRect(contours[np.argmax(areas)])
-        return ((x,y), (x+w,y), (x+w,y+h), (x,y+h))
+        return self.measure().points(min_area)
+    
+    def release(self):
+        '''
+        Measures the object (see measure()), then frees its images and masks,
+        keeping only the measurements, including the object's contour. This 
+        is useful when only the object's dimensions are needed, e.g. for 
+        long series of images: a released SegmentedObject takes a small 
+        fraction of the memory of one with full resolution images.
+        
+        Afterwards, the measurement methods still work (as does image_size), 
+        but the methods that need the images (exports, and setting masks, 
+        methods, thresholds, or cleanup) do not, and the setters return false.
+        
+        Returns:
+            The ObjectGeometry of the foreground object.
+        '''
+        
+        geometry = self.measure()
+        self.bg_model = None
+        self.bg_img = None
+        self.fg_img = None
+        self.fg_gray = None
+        self.fg_mask = None
+        self.diff_img = None
+        self.color_mask = None
+        self.rect_mask = None
+        self._fg_hsv = None
+        self._kernel = None
+        return geometry
+    
+    def _set_fg_gray(self):
+        '''
+        Helper method for converting the foreground image to grayscale and
+        filtering it (unless the background model accounts for noise, or 
+        the image was already filtered in color). Not to be used by user.
+        '''
+        
+        with stage("filter", self.label):
+            self.fg_gray = cv2.cvtColor(self.fg_img, cv2.COLOR_BGR2GRAY)
+            if self.bg_model.thresh is None and not self.fg_filtered:
+                self.fg_gray = cv2.bilateralFilter(self.fg_gray, 5, 100, 100)
+        return
+    
+    def _filter_fg_img(self):
+        '''
+        Helper method for filtering the foreground image in color, to smooth
+        out noise. Not to be used by user.
+        '''
+        
+        with stage("filter", self.label):
+            self.fg_img = cv2.bilateralFilter(self.fg_img, 5, 100, 100)
+        self.fg_filtered = True
+        return
+    
+    def _set_fg_mask_difference(self, diff):
+        '''
+        Helper method for thresholding a grayscale difference image into the
+        foreground mask. Not to be used by user.
+        '''
+        
+        self.diff_img = diff
+        self._apply_threshold()
+        return
+    
+    def _apply_threshold(self):
+        '''
+        Helper method for thresholding diff_img into the foreground mask, 
+        according to the threshold setting. Not to be used by user.
+        '''
+        
+        self._threshold_stale = False
+        if self.diff_img is None:
+            return
+        self._geometry = None
+        diff = self.diff_img
+        if self.threshold is None and not self.bg_model.thresh is None:
+            self.fg_mask = cv2.compare(diff, self.bg_model.thresh, cv2.CMP_GT)
+            self.threshold_value = None
+        elif self.threshold is None:
+            self.threshold_value, self.fg_mask = cv2.threshold(diff, 0, 255,
+                cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+        elif self.threshold == "roi":
+            window = self._get_window()
+            region = cv2.bitwise_and(self._get_rect_mask()[window], 
+                                     self._get_color_mask()[window])
+            self.threshold_value = otsu_threshold(diff[window], region)
+            if self.threshold_value is None: # all of it is arm color
+                self.threshold_value = otsu_threshold(diff[window])
+            self.fg_mask = np.zeros(diff.shape, np.uint8)
+            __, self.fg_mask[window] = cv2.threshold(diff[window], 
+                self.threshold_value, 255, cv2.THRESH_BINARY)
+        else:
+            self.threshold_value, self.fg_mask = cv2.threshold(diff, 
+                self.threshold, 255, cv2.THRESH_BINARY)
+        return
+    
+    def _get_window(self):
+        '''
+        Helper method returning the slices of the image covered by the 
+        rectangle (plus a 1 pixel border), or the whole image if there is 
+        none. Not to be used by user.
+        '''
+        
+        if self.rect is None:
+            return (slice(None), slice(None))
+        x, y, w, h = self.rect
+        return (slice(max(y-1, 0), y+h+2), slice(max(x-1, 0), x+w+2))
+    
+    def _get_search_window(self):
+        '''
+        Helper method returning the slices of the image searched for 
+        contours: the rectangle's window (see _get_window()), narrowed to the
+        search rectangle, if set. Not to be used by user.
+        '''
+        
+        window = self._get_window()
+        if self.search_rect is None:
+            return window
+        height, width = self.fg_mask.shape[:2]
+        top, bottom = window[0].indices(height)[:2]
+        left, right = window[1].indices(width)[:2]
+        x, y, w, h = self.search_rect
+        top, left = max(y, top), max(x, left)
+        bottom = max(top, min(y+h+1, bottom))
+        right = max(left, min(x+w+1, right))
+        return (slice(top, bottom), slice(left, right))
     
     def _get_contours(self):
         '''
@@ -333,22 +1200,316 @@ class SegmentedObject(object):
         according to the foreground image mask, after discounting areas marked
         as background by the ignore mask and rectangle mask.
         
+        If a rectangle is set, only the window it covers (plus a 1 pixel 
+        border, so contours touching its edges are unchanged) is searched,
+        and only its part within the search rectangle, if one is set.
+        Only outermost contours are extracted, since the largest contour is
+        never nested in another.
+        
         Returns:
             List of lists of points representing detected contours in 
             foreground mask.
         '''
         
-        if self.fg_mask is None:
+        if self._get_fg_mask() is None:
             return None
-        fg_mask = self.fg_mask.copy()
-        if not self.color_mask is None:
-            fg_mask = cv2.bitwise_and(fg_mask, self.color_mask)
-        if not self.rect_mask is None:
-            fg_mask = cv2.bitwise_and(fg_mask, self.rect_mask)
-        contours, __ = cv2.findContours(fg_mask, cv2.RETR_TREE,
-                                        cv2.CHAIN_APPROX_SIMPLE)
+        window = self._get_search_window()
+        offset = (window[1].start or 0, window[0].start or 0)
+        fg_mask = self.fg_mask[window].copy()
+        if fg_mask.size == 0: # search rectangle outside the window
+            return []
+        if not self.color_range is None:
+            fg_mask = cv2.bitwise_and(fg_mask, self._get_color_mask()[window])
+        if not self.rect is None:
+            fg_mask = cv2.bitwise_and(fg_mask, self._get_rect_mask()[window])
+        if not self.cleanup is None:
+            operation = self.cleanup[0]
+            if operation == "open" or operation == "open-close":
+                fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_OPEN, self._kernel)
+            if operation == "close" or operation == "open-close":
+                fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_CLOSE, self._kernel)
+        contours, __ = cv2.findContours(fg_mask, cv2.RETR_EXTERNAL,
+                                        cv2.CHAIN_APPROX_SIMPLE, offset=offset)
         return contours 
     
+def load_image(source, name="Image", reduce=1):
+    '''
+    Loads a color image from a file path, or decodes it from an archive
+    member (see read_archive()). Images that were already decoded (e.g. from
+    memory) are passed through unchanged, unless reduced.
+    
+    Images can be loaded at reduced resolution, e.g. for previews. Where 
+    OpenCV supports it (3.0 and later), the image is decoded at the reduced 
+    size directly, which is much faster for JPG images; otherwise it is 
+    decoded in full and then downscaled.
+    
+    Args:
+        source: file path to image, ArchiveMember, or image matrix.
+        name: (optional) description of the image for error messages.
+        reduce: (optional) factor to divide the image width and height by:
+                1, 2, 4, or 8.
+    Returns:
+        The image matrix.
+    Raises:
+        IOError: the image could not be read.
+    '''
+    
+    if isinstance(source, np.ndarray):
+        img = source
+    elif isinstance(source, ArchiveMember):
+        img = decode_image(source.data, name)
+    else:
+        flag = getattr(cv2, "IMREAD_REDUCED_COLOR_%d" % reduce, None)
+        img = cv2.imread(source) if flag is None else cv2.imread(source, flag)
+        if img is None:
+            raise IOError(name + " image not loaded successfully.")
+        if not flag is None:
+            return img
+    if reduce == 1:
+        return img
+    height, width = img.shape[:2]
+    return cv2.resize(img, (width // reduce, height // reduce), 
+                      interpolation=cv2.INTER_AREA)
+
+def prefetch_images(paths, depth=1):
+    '''
+    Loads images (see load_image()) ahead of their use on a background 
+    thread, so that reading and decoding the next images overlaps with 
+    processing the current one: the disk is not idle while OpenCV filters,
+    nor the CPU while the disk reads (OpenCV releases the interpreter lock
+    while decoding). At most depth loaded images wait to be used at a time.
+    
+    Args:
+        paths: iterable of file paths to images (or ArchiveMembers).
+        depth: (optional) number of images to load ahead.
+    Returns:
+        A generator of (path, image matrix) pairs, in order. An image that
+        could not be read raises IOError when it is reached. Closing the 
+        generator early stops the loading.
+    '''
+    
+    def load(path):
+        return (path, load_image(path, "Foreground"))
+    
+    pipe = Pipeline(queue_size=max(1, depth))
+    pipe.add_stage("prefetch", load)
+    return pipe.run(paths)
+
+def open_video(output_path, size, fps=10.0, codec="MJPG"):
+    '''
+    Opens a video file for writing color frames one at a time, e.g. with
+    many segment images, which is much faster and more compact than writing
+    an image file per frame.
+    
+    Args:
+        output_path: file path of output video (e.g. .avi).
+        size: pair (width, height) of the frame dimensions.
+        fps: (optional) frames per second.
+        codec: (optional) four character code of the video codec.
+    Returns:
+        A cv2.VideoWriter; write frames with its write() method, and close 
+        it with release().
+    Raises:
+        IOError: the video file could not be opened with the codec.
+    '''
+    
+    fourcc = cv2.cv.CV_FOURCC(*codec)
+    writer = cv2.VideoWriter(output_path, fourcc, fps, tuple(size))
+    if not writer.isOpened():
+        raise IOError("Video " + output_path + " not opened successfully.")
+    return writer
+
+class ArchiveMember(namedtuple("ArchiveMember", ["name", "data"])):
+    '''
+    An ArchiveMember is an image read from an archive by read_archive(), 
+    still encoded. It can be given wherever an image file path can (e.g. to
+    load_image() or SegmentedObject), and is decoded only then.
+    
+    Attributes:
+        name: path of the image within the archive.
+        data: byte string of the encoded image.
+    '''
+    
+    __slots__ = ()
+    
+    def __str__(self):
+        return self.name
+
+def read_archive(archive_path):
+    '''
+    Reads the PNG and JPG images stored in a zip or tar (optionally gzip or
+    bzip2 compressed) archive, in the order they are stored, without 
+    extracting them to disk. Tar archives are read in a single pass without
+    seeking, so a compressed one is decompressed only once; zip archives are
+    read member by member in order of their offsets.
+    
+    Args:
+        archive_path: file path to zip or tar archive.
+    Yields:
+        ArchiveMember of each image, still encoded.
+    Raises:
+        IOError: the file is not a readable zip or tar archive.
+    '''
+    
+    def wanted(name):
+        return name.endswith(".png") or name.endswith(".jpg")
+    
+    if zipfile.is_zipfile(archive_path):
+        try:
+            with zipfile.ZipFile(archive_path) as archive:
+                infos = sorted(archive.infolist(), key=lambda i: i.header_offset)
+                for info in infos:
+                    if wanted(info.filename):
+                        yield ArchiveMember(info.filename, archive.read(info))
+        except zipfile.BadZipfile as e:
+            raise IOError("Archive " + archive_path + " not read: " + str(e))
+        return
+    try:
+        archive = tarfile.open(archive_path, "r|*") # stream, never seek back
+    except tarfile.TarError:
+        raise IOError("Archive " + archive_path + " not opened successfully.")
+    try:
+        for member in archive:
+            if member.isfile() and wanted(member.name):
+                data = archive.extractfile(member).read()
+                yield ArchiveMember(member.name, data)
+    except tarfile.TarError as e:
+        raise IOError("Archive " + archive_path + " not read: " + str(e))
+    finally:
+        archive.close()
+    return
+
+def decode_image(data, name="Image"):
+    '''
+    Decodes a color image from an encoded (e.g. PNG or JPG) byte string in
+    memory, without touching the disk.
+    
+    Args:
+        data: byte string of the encoded image.
+        name: (optional) description of the image for error messages.
+    Returns:
+        The image matrix.
+    Raises:
+        IOError: the image could not be decoded.
+    '''
+    
+    buf = np.frombuffer(data, dtype=np.uint8)
+    img = cv2.imdecode(buf, cv2.CV_LOAD_IMAGE_COLOR) if buf.size else None
+    if img is None:
+        raise IOError(name + " image not decoded successfully.")
+    return img
+
+def read_frames(stream):
+    '''
+    Reads a stream of length-prefixed encoded images: each frame is a 4-byte
+    big-endian unsigned length, followed by that many bytes of the encoded
+    image. Frames are yielded as they arrive, still encoded (see 
+    decode_image()), until the stream ends.
+    
+    Args:
+        stream: binary file-like object, e.g. sys.stdin.
+    Yields:
+        Byte string of each encoded image.
+    Raises:
+        IOError: the stream ended in the middle of a frame.
+    '''
+    
+    while True:
+        header = _read_exactly(stream, 4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise IOError("Stream ended in frame length.")
+        length = struct.unpack(">I", header)[0]
+        data = _read_exactly(stream, length)
+        if len(data) < length:
+            raise IOError("Stream ended in frame data.")
+        yield data
+
+def _read_exactly(stream, size):
+    '''
+    Helper function reading size bytes from a stream, unless it ends first.
+    Not to be used by user.
+    '''
+    
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+def otsu_threshold(gray, mask=None):
+    '''
+    Computes a threshold for a grayscale image with Otsu's method, like
+    cv2.threshold() with THRESH_OTSU, but with the histogram built only from
+    the pixels under a mask.
+    
+    Args:
+        gray: 8-bit grayscale image.
+        mask: (optional) 8-bit mask of the same size; only pixels where it 
+              is non-zero are considered.
+    Returns:
+        The threshold value, or None if the mask leaves no pixels. Pixels 
+        above it are foreground.
+    '''
+    
+    hist = cv2.calcHist([gray], [0], mask, [256], [0, 256]).ravel()
+    if not hist.any():
+        return None
+    levels = np.arange(256)
+    w0 = np.cumsum(hist) # pixels at or below each candidate threshold
+    w1 = w0[-1] - w0
+    sum0 = np.cumsum(hist * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mu0 = sum0 / w0
+        mu1 = (sum0[-1] - sum0) / w1
+        variance = np.nan_to_num(w0 * w1 * (mu0 - mu1)**2)
+    return float(np.argmax(variance))
+
+def thumbnail(img, width=64):
+    '''
+    Shrinks an image to a small grayscale thumbnail, for cheaply detecting
+    whether two images differ.
+    
+    Args:
+        img: color image matrix.
+        width: (optional) pixel width of the thumbnail. The height is scaled
+               to keep the aspect ratio.
+    Returns:
+        The grayscale thumbnail, as a float32 matrix.
+    '''
+    
+    height = max(1, img.shape[0] * width // img.shape[1])
+    small = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    return np.float32(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+
+def _rectangle_size(points):
+    '''
+    Helper function for computing the width and height of a rectangle from
+    its 4 corners. Not to be used by user.
+    
+    The width corresponds to the axis closest to x, while the height to the 
+    axis closest to y.
+    
+    Args:
+        points: 4-tuple of pairs representing the rectangle corner coordinates.
+    Returns:
+        A tuple (w,h) of the rectangle's width and height.
+    '''
+    
+    p1, p2, __, p4 = points
+    d1 = hypot(p2[0] - p1[0], p2[1] - p1[1])
+    d2 = hypot(p4[0] - p1[0], p4[1] - p1[1])
+    if p2[0] - p1[0] != 0: # slope of d1 = infinity
+        s1 = float(p2[1] - p1[1]) / (p2[0] - p1[0])  
+        w, h = (d1, d2) if (-1 < s1 < 1) else (d2, d1)
+    else:
+        w, h = (d2, d1)
+    return (w, h)
+
 def check_fit((w1, h1), (w2, h2)):
     '''
     Checks if a rectangle 'fits' inside another rectangle.
@@ -386,11 +1547,81 @@ def convert_color_space(color, cv2_conversion_type):
     temp = cv2.cvtColor(temp, cv2_conversion_type)
     return temp[0][0]
 
+def set_thread_budget(workers=None, cv_threads=None):
+    '''
+    Splits the machine's cores between outer workers (e.g. a pool of threads
+    or processes each creating SegmentedObjects) and OpenCV's own internal
+    threads, so the two do not oversubscribe the CPU. OpenCV's thread count
+    is global to the current process: its threads form one pool, shared by
+    all worker threads (each worker process has its own).
+    
+    Args:
+        workers: (optional) number of outer workers. Defaults to the number
+                 of cores, since segmenting whole images in parallel scales
+                 better than threading each OpenCV call.
+        cv_threads: (optional) number of OpenCV threads of the process. 
+                    Defaults to the cores divided by the workers.
+    Returns:
+        A pair (workers, cv_threads) denoting the budget that was applied.
+    '''
+    
+    cores = multiprocessing.cpu_count()
+    workers = max(1, cores if workers is None else workers)
+    if cv_threads is None:
+        cv_threads = max(1, cores // workers)
+    cv2.setNumThreads(cv_threads)
+    return (workers, cv_threads)
+
+def expand_image_paths(sources):
+    '''
+    Expands a list of image sources into a list of image file paths. Each
+    source may be a file path, a directory (whose PNG and JPG images are 
+    taken in alphabetical order), or a glob pattern (whose matches are taken 
+    in alphabetical order). Images written by a previous run of this module's
+    command-line application (named *__roi.png or *_METHOD.png) are skipped
+    in directories and glob matches, so they are not segmented themselves.
+    
+    Args:
+        sources: list of file paths, directory paths, or glob patterns.
+    Returns:
+        List of image file paths, in the order of the sources.
+    Raises:
+        IOError: a source matches no images (e.g. a mistyped path).
+    '''
+    
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            matches = [os.path.join(source, f) for f in sorted(os.listdir(source))
+                       if f.endswith(".png") or f.endswith(".jpg")]
+        elif os.path.isfile(source):
+            matches = [source]
+        else:
+            matches = sorted(glob.glob(source))
+        if not os.path.isfile(source):
+            matches = [path for path in matches if not _is_output_image(path)]
+        if not matches:
+            raise IOError("No images found at " + source)
+        paths.extend(matches)
+    return paths
+
+def _is_output_image(path):
+    '''
+    Helper function returning whether an image is named as a result image
+    of the command-line application (see main()). Not to be used by user.
+    '''
+    
+    suffixes = ["__roi.png"] + ["_" + method + ".png" 
+                                for method in SEGMENT_METHODS]
+    return any(path.endswith(suffix) for suffix in suffixes)
+
 # Test script for SegmentedObject
 def main():
     parser = argparse.ArgumentParser(description="Segment object from background.")  
     parser.add_argument("background", help="path to background image")
-    parser.add_argument("foreground", help="path to foreground image")
+    parser.add_argument("foreground", nargs="*", 
+                        help="path(s) to foreground image(s), directories of "
+                             "images, or glob patterns")
     parser.add_argument("-c", "--color", nargs=6, type=int, 
                         metavar=("HUE_LOW", "SAT_LOW", "VAL_LOW",
                                  "HUE_HIGH", "SAT_HIGH", "VAL_HIGH"),
@@ -399,31 +1630,162 @@ def main():
                         metavar=("X", "Y", "WIDTH", "HEIGHT"),
                         help="specify rectangle region of interest")
     parser.add_argument("-m", "--method", default="simple",
-                        help="specify segmentation method")
+                        type=str.lower, choices=SEGMENT_METHODS,
+                        metavar="METHOD",
+                        help="specify segmentation method (simple, "
+                             "simple-gray, mog, or mog2)")
+    parser.add_argument("--cleanup", nargs=2, metavar=("OPERATION", "SIZE"),
+                        help="specify morphological cleanup of the mask "
+                             "(open, close, or open-close) and kernel size")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+                        help="specify number of worker threads")
+    parser.add_argument("-t", "--cv-threads", type=int, metavar="N",
+                        help="specify number of OpenCV threads (one pool "
+                             "shared by all workers)")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write results table to CSV file instead of "
+                             "printing it")
+    parser.add_argument("-n", "--no-images", action="store_true",
+                        help="do not write result images")
+    parser.add_argument("-p", "--pipe", action="store_true",
+                        help="read length-prefixed encoded foreground images "
+                             "from stdin and write JSON results to stdout")
+    parser.add_argument("--profile", nargs="?", const="obj_detect-profile",
+                        metavar="PREFIX",
+                        help="profile the run (per-function statistics of "
+                             "the main thread only), writing PREFIX.prof "
+                             "and PREFIX.txt (default: obj_detect-profile)")
     args = parser.parse_args()
+    if not args.foreground and not args.pipe:
+        parser.error("foreground images or --pipe required")
+    if args.cleanup:
+        operation, size = args.cleanup
+        if (not operation in CLEANUP_OPERATIONS or not size.isdigit() or 
+            int(size) < 1):
+            parser.error("--cleanup OPERATION must be one of %s, and SIZE a "
+                         "positive integer" % ", ".join(CLEANUP_OPERATIONS))
+        args.cleanup = (operation, int(size))
+    if args.foreground and args.pipe:
+        parser.error("foreground images cannot be given with --pipe")
     
-    print "Importing images:", args.background+",", args.foreground
-    obj = SegmentedObject(args.background, args.foreground)
+    if args.profile:
+        # with --pipe, stdout carries only results
+        profiling.run_profiled(lambda: _run(args), args.profile,
+                               stream=sys.stderr if args.pipe else None)
+    else:
+        _run(args)
+    return
+
+def _run(args):
+    if args.pipe:
+        _run_pipe(args)
+        return
+    workers, cv_threads = set_thread_budget(args.jobs, args.cv_threads)
+    print "Thread budget:", workers, "worker(s),", cv_threads, "OpenCV thread(s)"
+    try:
+        fg_paths = expand_image_paths(args.foreground)
+    except IOError as e:
+        print str(e) + "."
+        return
+    print "Importing background image:", args.background
+    bg_model = BackgroundModel(args.background) # shared by all foregrounds
+    print "Segmenting", len(fg_paths), "foreground image(s) with method:", args.method
+    color_range = None
     if args.color:
-        color_low = [args.color[0], args.color[1], args.color[2]]
-        color_high = [args.color[3], args.color[4], args.color[5]]
-        print "Setting ignored color range:", color_low, "-", color_high
-        obj.set_ignore_color(color_low, color_high)
+        color_range = (args.color[0:3], args.color[3:6])
+        print "Setting ignored color range:", color_range[0], "-", color_range[1]
     if args.rectangle:
         print "Setting rectangle region of interest:", args.rectangle
-        obj.set_rectangle(args.rectangle[0], args.rectangle[1], 
-                          args.rectangle[2], args.rectangle[3])
-    if args.method:
-        print "Attempt to use segmentation method:", args.method
-        obj.set_fg_mask_method(args.method)
-        
-    out_prefix = os.path.splitext(args.foreground)[0]
-    print "Writing result images to folder:", out_prefix
-    if args.color or args.rectangle:
-        obj.export_region_segment(out_prefix + "__roi.png")    
-    obj.export_object_segment(out_prefix + "_" + args.method + ".png", True) 
-    print "Done! Bounding rectangle size:", obj.get_object_rectangle_size() 
+    if args.cleanup:
+        print "Setting mask cleanup:", args.cleanup[0], args.cleanup[1]
+    
+    def segment(fg_path): # a failed image gets an error row, not the batch
+        try:
+            obj = SegmentedObject(bg_model, fg_path, args.method, color_range,
+                                  args.rectangle)
+            if args.cleanup:
+                obj.set_cleanup(*args.cleanup)
+            if not args.no_images:
+                out_prefix = os.path.splitext(fg_path)[0]
+                if args.color or args.rectangle:
+                    obj.export_region_segment(out_prefix + "__roi.png")    
+                obj.export_object_segment(out_prefix + "_" + args.method + ".png", 
+                                          True)
+            w, h = obj.get_object_rectangle_size()
+            w_min, h_min = obj.get_object_rectangle_size(min_area=True)
+        except (IOError, cv2.error, ValueError) as e:
+            return [fg_path, "", "", "", "", str(e)]
+        return [fg_path, w, h, w_min, h_min, ""]
+    
+    if workers > 1 and len(fg_paths) > 1:
+        pool = ThreadPool(min(workers, len(fg_paths)))
+        rows = pool.map(segment, fg_paths)
+        pool.close()
+        pool.join()
+    else:
+        rows = [segment(fg_path) for fg_path in fg_paths]
+    
+    header = ["Image", "Width-px", "Height-px", "Min-width-px", "Min-height-px",
+              "Error"]
+    failed = sum(1 for row in rows if row[-1])
+    if failed:
+        print failed, "image(s) could not be segmented."
+    if args.output:
+        with open(args.output, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        print "Done! Results table written to", args.output
+    else:
+        print "Done! Results:"
+        width = max(len(header[0]), max(len(row[0]) for row in rows))
+        print header[0].ljust(width), " ".join("%13s" % c for c in header[1:-1])
+        for row in rows:
+            if row[-1]:
+                print row[0].ljust(width), "Error:", row[-1]
+            else:
+                print row[0].ljust(width), " ".join("%13.1f" % v 
+                                                    for v in row[1:-1])
+    return
 
+def _run_pipe(args):
+    # stdout carries only results, so status goes to stderr
+    if sys.platform == "win32": # stdin must not translate line endings
+        import msvcrt
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+    workers, cv_threads = set_thread_budget(args.jobs, args.cv_threads)
+    print >> sys.stderr, "Thread budget:", workers, "worker(s),", cv_threads, "OpenCV thread(s)"
+    print >> sys.stderr, "Importing background image:", args.background
+    bg_model = BackgroundModel(args.background)
+    color_range = None
+    if args.color:
+        color_range = (args.color[0:3], args.color[3:6])
+    print >> sys.stderr, "Reading frames from stdin with method:", args.method
+    
+    def segment((index, data)):
+        result = {"frame": index}
+        try:
+            img = decode_image(data, "Frame")
+            obj = SegmentedObject(bg_model, img, args.method, color_range,
+                                  args.rectangle)
+            if args.cleanup:
+                obj.set_cleanup(*args.cleanup)
+            result.update(obj.measure().as_dict())
+        except (IOError, cv2.error, ValueError) as e: # e.g. wrong frame size
+            result["error"] = str(e)
+        return json.dumps(result)
+    
+    # frames are read only as workers free up, so a fast producer cannot
+    # fill memory with frames waiting to be segmented
+    pipe = Pipeline(queue_size=workers)
+    pipe.add_stage("segment", segment, workers)
+    lines = pipe.run(enumerate(read_frames(sys.stdin))) # keeps frame order
+    try:
+        for line in lines:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+    finally:
+        lines.close()
     return
     
 if __name__ == "__main__":
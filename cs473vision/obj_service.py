@@ -0,0 +1,285 @@
+import BaseHTTPServer
+import json
+import Queue
+import SocketServer
+import threading
+import time
+
+from collections import deque
+from obj_detect import decode_image
+
+# Largest request body accepted by serve(), in bytes
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+class ServiceBusy(Exception):
+    '''
+    Raised when a segmentation request is submitted to a SegmentationService
+    whose request queue is full.
+    '''
+    pass
+
+class ServiceTimeout(RuntimeError):
+    '''
+    Raised when a segmentation request submitted to a SegmentationService
+    gets no result within its timeout.
+    '''
+    pass
+
+class SegmentationService(object):
+    '''
+    A SegmentationService segments compressed object images on behalf of
+    other processes, keeping a BaxterObject's state warm between requests:
+    the background model is built and filtered once, and the arm color
+    range, region of interest, segmentation method, thresholding and mask
+    cleanup are reused as they were set on the BaxterObject.
+
+    Each request is segmented on its own, as the requests are not known to
+    form a series: deduplication and tracking of compressed images do not
+    apply, and a series threshold (see
+    BaxterObject.set_compressed_threshold()) is only reused if it was
+    already computed for the loaded images; otherwise the threshold setting
+    is applied to each image.
+
+    Requests are put in a bounded queue and processed by a fixed pool of
+    worker threads. A full queue rejects new requests (see ServiceBusy)
+    instead of growing without bound. Latency and queue depth statistics
+    are kept (see get_stats()). A request whose caller stopped waiting
+    (see segment()) is skipped if it has not started yet.
+
+    Attributes:
+        baxter: BaxterObject whose settings are used to segment images.
+    '''
+
+    def __init__(self, baxter, workers=None, queue_size=16, history=1000):
+        '''
+        Initiates SegmentationService and starts its worker threads.
+
+        Args:
+            baxter: BaxterObject with at least a background image set.
+            workers: (optional) number of worker threads. Defaults to the
+                     BaxterObject's thread budget (see set_thread_budget()).
+            queue_size: (optional) maximum number of requests waiting to be
+                        processed.
+            history: (optional) number of most recent requests to compute
+                     latency percentiles from.
+        '''
+
+        self.baxter = baxter
+        self.baxter.prepare_background() # warm up before the first request
+        self._queue = Queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=history) # (wait, total) seconds
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._cancelled = 0
+        self._max_depth = 0
+        self._started = time.time()
+        self._threads = []
+        for i in range(workers if workers else self.baxter.get_workers()):
+            thread = threading.Thread(target=self._work,
+                                      name="segment-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return
+
+    def segment(self, data, timeout=None):
+        '''
+        Segments an encoded compressed object image, waiting for a worker
+        thread to process it.
+
+        Args:
+            data: byte string of the encoded (e.g. PNG or JPG) image.
+            timeout: (optional) seconds to wait for the result. A request
+                     that has not started by then is cancelled.
+        Returns:
+            A dict of the object's measurements (see
+            ObjectGeometry.as_dict()), along with the keys "mm_per_px" and
+            "min_rect_size_mm" if a measurement reference was set.
+        Raises:
+            ServiceBusy: the request queue is full.
+            IOError: the image could not be decoded.
+            ServiceTimeout: no result arrived within the timeout.
+        '''
+
+        request = {"data": data, "queued": time.time(),
+                   "done": threading.Event()}
+        try:
+            self._queue.put_nowait(request)
+        except Queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise ServiceBusy("Request queue is full.")
+        with self._lock:
+            self._max_depth = max(self._max_depth, self._queue.qsize())
+        if not request["done"].wait(timeout):
+            with self._lock:
+                request["cancelled"] = True # skipped unless already started
+            raise ServiceTimeout("Segmentation request timed out.")
+        if "error" in request:
+            raise request["error"]
+        return request["result"]
+
+    def get_stats(self):
+        '''
+        Returns statistics of the requests processed so far.
+
+        Returns:
+            A dict with the number of requests "completed", "failed",
+            "rejected" and "cancelled" (timed out before starting), the
+            current and maximum "queue_depth" and
+            "max_queue_depth", the "queue_size" and "workers", the "uptime",
+            and the mean, 50th, 90th and 99th percentile "latency_*" (time
+            from submission to result) and "wait_*" (time in queue) over
+            the most recent requests, in milliseconds.
+        '''
+
+        with self._lock:
+            latencies = list(self._latencies)
+            stats = {"completed": self._completed,
+                     "failed": self._failed,
+                     "rejected": self._rejected,
+                     "cancelled": self._cancelled,
+                     "queue_depth": self._queue.qsize(),
+                     "max_queue_depth": self._max_depth,
+                     "queue_size": self._queue.maxsize,
+                     "workers": len(self._threads),
+                     "uptime": time.time() - self._started}
+        for i, name in enumerate(["wait", "latency"]):
+            values = sorted(1000 * l[i] for l in latencies)
+            stats[name + "_mean"] = sum(values) / len(values) if values else 0.0
+            for p in (50, 90, 99):
+                stats[name + "_p%d" % p] = _percentile(values, p)
+        return stats
+
+    def _work(self):
+        while True:
+            request = self._queue.get()
+            with self._lock:
+                cancelled = request.get("cancelled", False)
+                if cancelled:
+                    self._cancelled += 1
+            if cancelled: # the caller is gone
+                self._queue.task_done()
+                continue
+            start = time.time()
+            try:
+                request["result"] = self._segment(request["data"])
+            except Exception as e:
+                request["error"] = e
+            end = time.time()
+            with self._lock:
+                if "error" in request:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+                self._latencies.append((start - request["queued"],
+                                        end - request["queued"]))
+            request["done"].set()
+            self._queue.task_done()
+
+    def _segment(self, data):
+        geometry = self.baxter.measure_compressed_image(decode_image(data))
+        result = geometry.as_dict()
+        mm_per_px = self.baxter.get_mm_per_px()
+        if mm_per_px > 0:
+            result["mm_per_px"] = mm_per_px
+            result["min_rect_size_mm"] = [v * mm_per_px for v in
+                                          result["min_rect_size"]]
+        return result
+
+class _ServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Helper class handling HTTP requests for serve(). Not to be used by user.
+    '''
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._reply(200, self.server.service.get_stats())
+        else:
+            self._reply(404, {"error": "Unknown path " + self.path})
+        return
+
+    def do_POST(self):
+        if self.path != "/segment":
+            self._reply(404, {"error": "Unknown path " + self.path})
+            return
+        try:
+            length = int(self.headers.getheader("Content-Length"))
+        except (TypeError, ValueError):
+            self._reply(400, {"error": "Missing or invalid Content-Length"})
+            return
+        if not 0 < length <= MAX_REQUEST_BYTES:
+            self._reply(413 if length > 0 else 400,
+                        {"error": "Request body must be 1 to %d bytes" %
+                                  MAX_REQUEST_BYTES})
+            return
+        data = self.rfile.read(length)
+        timeout = self.server.request_timeout
+        try:
+            self._reply(200, self.server.service.segment(data, timeout))
+        except ServiceBusy as e:
+            self._reply(503, {"error": str(e)})
+        except ServiceTimeout as e:
+            self._reply(504, {"error": str(e)})
+        except IOError as e:
+            self._reply(400, {"error": str(e)})
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+        return
+
+    def log_message(self, format, *args):
+        return # per-request logging would dominate the output
+
+    def _reply(self, code, body):
+        content = json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        return
+
+def serve(service, port, host="127.0.0.1", timeout=None):
+    '''
+    Serves a SegmentationService over HTTP until interrupted. An encoded
+    image POSTed to /segment is answered with its measurements in JSON (or
+    status 503 if the request queue is full, 504 if no result arrived within
+    the timeout, 413 if it is larger than MAX_REQUEST_BYTES, and 400 if it
+    has no valid Content-Length or cannot be decoded), and GET /stats
+    answers with the service's statistics.
+
+    Args:
+        service: SegmentationService to serve.
+        port: port number to listen on.
+        host: (optional) address to listen on. Defaults to localhost only.
+        timeout: (optional) seconds to wait for each request's result (see
+                 SegmentationService.segment()), or None to wait until it
+                 is done.
+    '''
+
+    server = _ServiceServer((host, port), _ServiceHandler)
+    server.service = service
+    server.request_timeout = timeout
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return
+
+def _percentile(values, p):
+    '''
+    Helper function returning the p-th percentile of sorted values (nearest
+    rank), or 0 if there are none. Not to be used by user.
+    '''
+
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
@@ -0,0 +1,134 @@
+import ctypes
+import multiprocessing
+import numpy as np
+
+from multiprocessing.sharedctypes import RawArray
+from obj_detect import BackgroundModel, SegmentedObject
+
+class SharedBackground(object):
+    '''
+    A SharedBackground holds a BackgroundModel's images in shared memory, so
+    that worker processes can segment against it without each re-reading and
+    re-filtering the background, or receiving a pickled copy of it. The
+    images are copied into shared memory once; workers started afterwards
+    (e.g. the Pool of measure_processes()) attach to them read-only, without
+    copying.
+
+    The settings of compressed object segmentation are shared along with it:
+    the color range to ignore (derived from the arm image), the threshold,
+    the mask cleanup, and the Undistorter the background was built with, if
+    any, so the workers undistort their images alike.
+
+    Attributes:
+        color_range: 2-tuple (low, high) of the HSV color range to ignore, or
+                     None.
+        undistorter: Undistorter applied to the foreground images, or None.
+        threshold: Thresholding of the "simple" methods (see
+                   SegmentedObject.set_threshold()).
+        cleanup: Pair (operation, size) of the mask cleanup (see
+                 SegmentedObject.set_cleanup()), or None.
+    '''
+
+    def __init__(self, model, color_range=None, undistorter=None,
+                 threshold=None, cleanup=None):
+        '''
+        Initiates SharedBackground by copying a BackgroundModel's images into
+        shared memory.
+
+        Args:
+            model: BackgroundModel to share.
+            color_range: (optional) 2-tuple of the color range to ignore.
+            undistorter: (optional) Undistorter the model was built with.
+            threshold: (optional) thresholding of the "simple" methods.
+            cleanup: (optional) pair (operation, size) of the mask cleanup.
+        '''
+
+        self.color_range = color_range
+        self.undistorter = undistorter
+        self.threshold = threshold
+        self.cleanup = cleanup
+        self._arrays = {} # name -> (RawArray, dtype, shape)
+        for name in ("img", "noise", "thresh"):
+            array = getattr(model, name)
+            if array is None:
+                continue
+            array = np.ascontiguousarray(array)
+            raw = RawArray(ctypes.c_byte, array.nbytes)
+            np.frombuffer(raw, array.dtype).reshape(array.shape)[...] = array
+            self._arrays[name] = (raw, array.dtype.str, array.shape)
+        return
+
+    def attach(self):
+        '''
+        Returns a BackgroundModel whose images are read-only views of the
+        shared memory. Call it in the worker processes.
+
+        Returns:
+            The shared BackgroundModel.
+        '''
+
+        model = BackgroundModel.__new__(BackgroundModel)
+        model.noise = None
+        model.thresh = None
+        for name, (raw, dtype, shape) in self._arrays.items():
+            view = np.frombuffer(raw, np.dtype(dtype)).reshape(shape)
+            view.flags.writeable = False
+            setattr(model, name, view)
+        return model
+
+def measure_processes(shared, fg_paths, processes=None, method="simple",
+                      rectangle=None):
+    '''
+    Segments and measures foreground images in a pool of worker processes,
+    all segmenting against the same SharedBackground, with its settings.
+
+    Args:
+        shared: SharedBackground to segment against.
+        fg_paths: list of file paths to foreground images.
+        processes: (optional) number of worker processes. Defaults to the
+                   number of cores.
+        method: (optional) segmentation method (see
+                SegmentedObject.set_fg_mask_method()).
+        rectangle: (optional) 4-tuple (x, y, width, height) of the region
+                   of interest.
+    Returns:
+        A list of the ObjectGeometry of each foreground image's object.
+    Raises:
+        IOError: a foreground image could not be read.
+        ValueError: the method is not supported.
+    '''
+
+    pool = multiprocessing.Pool(processes, _init_shared, (shared,))
+    try:
+        return pool.map(_measure, [(path, method, rectangle)
+                                   for path in fg_paths])
+    finally:
+        pool.close()
+        pool.join()
+
+_worker_model = None # BackgroundModel of a worker process
+_worker_shared = None # SharedBackground it was attached from
+
+def _init_shared(shared):
+    '''
+    Helper function attaching a worker process to a SharedBackground. Not to
+    be used by user.
+    '''
+
+    global _worker_model, _worker_shared
+    _worker_model = shared.attach()
+    _worker_shared = shared
+    return
+
+def _measure((fg_path, method, rectangle)):
+    '''
+    Helper function segmenting and measuring a foreground image in a worker
+    process. Not to be used by user.
+    '''
+
+    shared = _worker_shared
+    obj = SegmentedObject(_worker_model, fg_path, method, shared.color_range,
+                          rectangle, shared.threshold, shared.undistorter)
+    if not shared.cleanup is None:
+        obj.set_cleanup(*shared.cleanup)
+    return obj.release()
@@ -0,0 +1,176 @@
+import Queue
+import sys
+import threading
+
+class Pipeline(object):
+    '''
+    A Pipeline processes a stream of items through a sequence of stages,
+    e.g. decoding, segmenting and writing images. Each stage is run by its
+    own threads, so the stages overlap: while one image is segmented, the
+    next can already be read from disk and the previous written to it. As
+    OpenCV releases the interpreter lock, so can several segmentations.
+
+    Stages are connected by bounded queues. A stage that falls behind makes
+    the ones before it wait (backpressure), so the number of items in
+    flight, and thus memory use, stays bounded however long the stream is.
+    Results come out in input order, whatever each stage's concurrency.
+
+    A stage with a single worker processes the items in input order, so it
+    may keep state from one item to the next: results of a parallel stage
+    before it are put back in order (buffered until the earlier ones are
+    done) before being passed to it.
+    '''
+
+    def __init__(self, queue_size=4):
+        '''
+        Initiates Pipeline without any stages.
+
+        Args:
+            queue_size: (optional) maximum number of items waiting between
+                        two stages.
+        '''
+
+        self._queue_size = queue_size
+        self._stages = [] # (name, func, workers)
+        return
+
+    def add_stage(self, name, func, workers=1):
+        '''
+        Appends a stage to the Pipeline.
+
+        Args:
+            name: name of the stage, used for its threads.
+            func: function called on each item, whose return value is passed
+                  to the next stage.
+            workers: (optional) number of threads running the stage.
+        Returns:
+            The Pipeline, so calls can be chained.
+        '''
+
+        self._stages.append((name, func, max(1, workers)))
+        return self
+
+    def run(self, items):
+        '''
+        Runs the items through the stages. Items are read from the iterable
+        only as the first stage has room for them. If a stage raises an
+        exception, it is re-raised here, in place of that item's result.
+        Closing the generator early stops the stages.
+
+        Args:
+            items: iterable of input items.
+        Returns:
+            A generator of the last stage's results, in input order.
+        '''
+
+        stop = threading.Event()
+        queues = [Queue.Queue(self._queue_size) for __ in range(len(self._stages) + 1)]
+        threads = [threading.Thread(target=self._feed, name="pipeline-feed",
+                                    args=(items, queues[0], stop))]
+        for i, (name, func, workers) in enumerate(self._stages):
+            next_workers = (self._stages[i+1][2] if i+1 < len(self._stages)
+                            else 1)
+            remaining = [workers] # workers of the stage still running
+            for j in range(workers):
+                threads.append(threading.Thread(
+                    target=self._work, name="pipeline-%s-%d" % (name, j),
+                    args=(func, queues[i], queues[i+1], stop, remaining,
+                          next_workers, workers == 1)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return self._collect(queues[-1], stop)
+
+    def _feed(self, items, out_queue, stop):
+        index = -1
+        try:
+            for index, item in enumerate(items):
+                if not _put(out_queue, (index, item, None), stop):
+                    return
+        except Exception: # pass on to the consumer, as the next item
+            _put(out_queue, (index + 1, None, sys.exc_info()), stop)
+        for __ in range(self._stages[0][2]):
+            _put(out_queue, None, stop)
+        return
+
+    def _work(self, func, in_queue, out_queue, stop, remaining, next_workers,
+              ordered):
+        pending = {} # entries that overtook earlier ones, if ordered
+        next_index = 0
+        while True:
+            entry = _get(in_queue, stop)
+            if entry is None: # end of stream, or stopped
+                break
+            if ordered:
+                pending[entry[0]] = entry
+                entries = []
+                while next_index in pending:
+                    entries.append(pending.pop(next_index))
+                    next_index += 1
+            else:
+                entries = [entry]
+            for index, item, error in entries:
+                if error is None:
+                    try:
+                        item = func(item)
+                    except Exception:
+                        item, error = None, sys.exc_info()
+                if not _put(out_queue, (index, item, error), stop):
+                    return
+        with _lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last: # the next stage may end too
+            for __ in range(next_workers):
+                _put(out_queue, None, stop)
+        return
+
+    def _collect(self, queue, stop):
+        pending = {} # results that overtook earlier ones
+        next_index = 0
+        try:
+            while True:
+                entry = _get(queue, stop)
+                if entry is None:
+                    break
+                index, item, error = entry
+                pending[index] = (item, error)
+                while next_index in pending:
+                    item, error = pending.pop(next_index)
+                    if not error is None:
+                        raise error[0], error[1], error[2]
+                    yield item
+                    next_index += 1
+        finally:
+            stop.set()
+        return
+
+_lock = threading.Lock()
+
+def _put(queue, entry, stop):
+    '''
+    Helper function putting an entry in a bounded queue, waiting for room
+    unless the pipeline is stopped. Not to be used by user.
+    '''
+
+    while not stop.is_set():
+        try:
+            queue.put(entry, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _get(queue, stop):
+    '''
+    Helper function getting an entry from a queue, waiting for one unless
+    the pipeline is stopped (in which case None is returned). Not to be
+    used by user.
+    '''
+
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+    return None
@@ -0,0 +1,149 @@
+import cProfile
+import pstats
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Pipeline stages timed per image, in table order
+STAGES = ("load", "filter", "mask", "contours", "geometry", "export")
+
+_timings = None # {label: {stage: seconds}} while stage timing is enabled
+_labels = [] # labels in the order they were first timed
+_lock = threading.Lock()
+
+@contextmanager
+def stage(name, label):
+    '''
+    Context manager timing a pipeline stage of an image, if stage timing is
+    enabled (see enable_stage_timing()); otherwise it does nothing. Time
+    spent in the same stage for the same image accumulates.
+    
+    Args:
+        name: name of the stage, one of STAGES.
+        label: name of the image the stage is run for, e.g. its file path.
+    '''
+    
+    if _timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        with _lock:
+            if not label in _timings:
+                _timings[label] = dict.fromkeys(STAGES, 0.0)
+                _labels.append(label)
+            _timings[label][name] += elapsed
+    return
+
+def enable_stage_timing(enabled=True):
+    '''
+    Enables (and resets) or disables timing of pipeline stages per image.
+    
+    Args:
+        enabled: whether to time stages.
+    '''
+    
+    global _timings
+    with _lock:
+        _timings = {} if enabled else None
+        del _labels[:]
+    return
+
+def stage_table():
+    '''
+    Formats the stage timings recorded since stage timing was enabled as a
+    table, one row per image and one column per stage (in milliseconds).
+    
+    Returns:
+        The table, as a string.
+    '''
+    
+    lines = ["%-40s" % "image" + "".join("%10s" % s for s in STAGES) + 
+             "%10s" % "total"]
+    totals = dict.fromkeys(STAGES, 0.0)
+    with _lock:
+        for label in _labels:
+            times = _timings[label]
+            for s in STAGES:
+                totals[s] += times[s]
+            lines.append("%-40s" % str(label)[-40:] + 
+                         "".join("%10.1f" % (1000*times[s]) for s in STAGES) +
+                         "%10.1f" % (1000*sum(times.values())))
+    lines.append("%-40s" % "TOTAL" + 
+                 "".join("%10.1f" % (1000*totals[s]) for s in STAGES) +
+                 "%10.1f" % (1000*sum(totals.values())))
+    return "\n".join(lines)
+
+def peak_memory_mb():
+    '''
+    Returns the high-water mark of the current process's resident memory,
+    i.e. its largest resident size since it started. It never decreases, so
+    it bounds the memory of any part of a run, but does not measure it.
+    
+    Returns:
+        Peak resident memory, in megabytes, or None where it is not 
+        available (e.g. on Windows).
+    '''
+    
+    try:
+        import resource # Unix only
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": # bytes, rather than kilobytes
+        peak /= 1024
+    return peak / 1024.0
+
+def run_profiled(func, output_prefix, top=30, stream=None):
+    '''
+    Runs a function under the profiler, with stage timing enabled, and 
+    writes the results: the raw profiler statistics to output_prefix.prof 
+    (readable by pstats), and a report with the slowest functions, the 
+    stage timing table, and the peak memory to output_prefix.txt. The stage
+    table and peak memory are also printed, to stream. The peak memory is 
+    the process's high-water mark (see peak_memory_mb()), which includes 
+    whatever the process did before func, rather than func's own use.
+    
+    The profiler only sees the calling thread. Work done by worker threads
+    (e.g. of a ThreadPool or Pipeline) is missing from the per-function
+    statistics, though it is still counted in the stage timings.
+    
+    Args:
+        func: function to run, taking no arguments.
+        output_prefix: file path prefix of the output files.
+        top: (optional) number of functions to list in the report.
+        stream: (optional) file the summary is printed to, instead of 
+                standard output (e.g. standard error, if standard output 
+                carries results).
+    Returns:
+        The return value of func.
+    '''
+    
+    if stream is None:
+        stream = sys.stdout
+    enable_stage_timing()
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(func)
+    finally:
+        profiler.dump_stats(output_prefix + ".prof")
+        table = stage_table()
+        peak = peak_memory_mb()
+        memory = ("Process peak memory: unavailable" if peak is None else
+                  "Process peak memory (high-water mark since start): "
+                  "%.1f MB" % peak)
+        with open(output_prefix + ".txt", "w") as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(top)
+            f.write("Stage timings (ms):\n" + table + "\n\n" + memory + "\n")
+        enable_stage_timing(False)
+        print >> stream, "Stage timings (ms):"
+        print >> stream, table
+        print >> stream, memory
+        print >> stream, "Profile written to", output_prefix + ".prof,", output_prefix + ".txt"
+    return result
@@ -8,10 +8,19 @@ import argparse
 import cv2
 import numpy as np
 import os
+import obj_service
+import profiling
+import threading
 
-from obj_detect import SegmentedObject
+from obj_detect import (CLEANUP_OPERATIONS, SegmentedObject, load_image, 
+                        read_archive)
 from obj_baxter import BaxterObject
 
+# Names of the parameter trackbars of BaxterExperiment.display_results()
+TOLERANCE_BARS = ("Hue tol", "Sat tol", "Val tol")
+THRESHOLD_BAR = "Threshold"
+ROI_BARS = ("ROI x %", "ROI y %", "ROI w %", "ROI h %")
+
 class BaxterExperiment(BaxterObject):
     '''
     A BaxterExperiment is a BaxterObject with methods to facilitate the 
@@ -19,6 +28,10 @@ class BaxterExperiment(BaxterObject):
     and exporting results en masse, as well as displaying the result images
     (along with segments and bounding rectangles) in a window.
     
+    Compressed object images can also be streamed rather than loaded: their
+    paths are kept in compress_paths, and they are only segmented one at a 
+    time when results are exported (see BaxterObject.iter_compressed_sizes()).
+    
     A notable method is display_results(), which brings up result images of
     the segmentation algorithm in a window. On Windows, it can also accept
     keyboard input:
@@ -30,7 +43,11 @@ class BaxterExperiment(BaxterObject):
         - Pressing 'r' toggles what bounding rectangle to display.
         - Pressing TAB temporarily displays the background image, allowing
           for quick comparison between the background and current image.
+        - Pressing 'f' toggles between preview and full resolution, if
+          preview mode is enabled (see set_preview()).
     
+    The window can also show trackbars to tune the segmentation parameters
+    with, whose effect is shown right away.
     '''
     
     def __init__(self, bg_file=None):
@@ -46,19 +63,40 @@ class BaxterExperiment(BaxterObject):
         self._name = "BaxterObject"
         self._bar = "Image"
         
+        self.compress_paths = [] # streamed, instead of loaded, if not empty
+        
         self._pos = 0
-        self._total = 1
-        self._seg = 0 # 0 = none, 1 = region, 2 = object
+        self._total = 1
+        self._seg = 0 # 0 = none, 1 = region, 2 = object
         self._rect = 2 # 0 = none, 1 = upright, 2 = min area
+        
+        self._preview_width = None # max. displayed width, if previewing
+        self._full = False # whether to show full resolution anyway
+        self._previews = {} # display index -> (preview, scale); 0 = background
+        
+        self._tuning = False # whether the parameter trackbars are live
+        self._auto_threshold = None # threshold mode of the 0 trackbar value
+        self._lock = threading.Lock() # window against the series update
+        self._series_thread = None # measures the series in the background
+        self._series_stop = None
         return
     
-    def export_results(self, output_dir, segment=True, table=True):
+    def export_results(self, output_dir, segment=True, table=True, 
+                       binary=False, video=False):
         '''
         Initiates BaxterExperiment, with (optionally) a user-specified 
         background image.
         
         Args:
             output_dir: directory path to write output images to.
+            segment: whether to write the segmented object images (when
+                     streaming, one per compressed object image).
+            table: whether to write the table of object sizes (sizes.csv).
+            binary: whether to also write the table of object sizes in
+                    NumPy's binary format (sizes.npz).
+            video: whether to write the compressed object segments as the
+                   frames of one video (compression_seg.avi), instead of
+                   one image each when streaming.
         Returns:
             True if the output directory is valid; false otherwise.
         '''
@@ -72,8 +110,20 @@ class BaxterExperiment(BaxterObject):
             self.export_arm_segment(output_dir+"arm-_seg.png")
             self.export_uncompressed_segment(output_dir+"object-_seg.png")
             self.export_compress_segment(output_dir+"compression-_seg.png")      
+        if video and self.compress_obj:
+            self.export_compress_video(output_dir+"compression_seg.avi")
+        stream = None
+        if self.compress_paths and (segment or table or binary or video):
+            stream = self.iter_compressed_sizes(self.compress_paths, 
+                segment_dir=output_dir if segment and not video else None,
+                segment_video=output_dir+"compression_seg.avi" if video 
+                              else None)
+            if (table and binary) or not (table or binary): # reused, or unused
+                stream = list(stream)
         if table:
-            self.export_sizes(output_dir + "sizes.csv")
+            self.export_sizes(output_dir + "sizes.csv", stream)
+        if binary:
+            self.export_sizes_npz(output_dir + "sizes.npz", stream)
         return True
 
     def print_results(self):
@@ -93,9 +143,10 @@ class BaxterExperiment(BaxterObject):
         print "Compressed object size (px):", self.get_compressed_size()
         return
     
-    def import_images(self, path_dir): # Caution: very specific
+    def import_images(self, path_dir, stream=False): # Caution: very specific
         '''
-        Loads images from a directory into the BaxterExperiment. The specific 
+        Loads images from a directory, or a zip or tar archive, into the 
+        BaxterExperiment. The specific 
         naming convention for the images is as follows: the background image is 
         "background"/"bg", the reference object image is "reference"/"ref", 
         the arm image is "arm", the box image is "box", the uncompressed 
@@ -103,42 +154,116 @@ class BaxterExperiment(BaxterObject):
         start with "compression". Images that are not named this way
         are ignored.
         
+        Several background images may be given by appending a suffix, e.g. 
+        "bg-1", "bg-2", in which case they are combined into one background
+        model (see BaxterObject.set_background_images()).
+        
         The method only reads PNG or JPG image files. Also note that the 
-        compression images are added in alphabetical order.
+        compression images are added in alphabetical order. If a calibration
+        profile was loaded (see BaxterObject.load_calibration()), the
+        reference object image is skipped if the profile had a measurement,
+        and the arm image if it had an arm color range.
+        
+        Archives are read without being extracted, in a single pass in the 
+        order their images are stored (see obj_detect.read_archive()), so the
+        compression images are added in that order instead. Images stored 
+        before the background images are held, still encoded, until they
+        have been read, so archives are best created with the background
+        images first, and together. When streaming, the compression images
+        of an archive are kept encoded in memory until they are exported.
         
         Args:
-            path_dir: directory path of the images to load.
+            path_dir: directory path of the images to load, or file path to
+                      a zip or tar (optionally compressed) archive of them.
+            stream: whether to only record the paths of the compression 
+                    images in compress_paths, to be streamed on export,
+                    instead of loading them.
         Returns:
-            True if the input directory is valid; false otherwise.
+            True if the input directory or archive is valid; false otherwise.
         '''
         
+        if os.path.isfile(path_dir):
+            return self._import_archive(path_dir, stream)
         if not os.path.isdir(path_dir):
             return False
         if not path_dir.endswith("/"):
             path_dir += "/"
-        for file in os.listdir(path_dir): # Must find background first
+        bg_files = []
+        for file in sorted(os.listdir(path_dir)): # Must find background first
             if file.endswith(".png") or file.endswith(".jpg"):
-                name = os.path.splitext(file)[0]
-                if name == "background" or name == "bg":
-                    self.bg_path = path_dir + file
-                    break
+                if _is_background(file):
+                    bg_files.append(path_dir + file)
+        if bg_files:
+            self._import_background(bg_files)
         if not self.bg_path:
             return False
         for file in sorted(os.listdir(path_dir)):
             if file.endswith(".png") or file.endswith(".jpg"):
-                name = os.path.splitext(file)[0]
-                if name == "reference" or name == "ref":
-                    self.set_measure_image(path_dir + file, 100, 100)
-                elif name == "arm":
-                    self.set_arm_image(path_dir + file)
-                elif name == "box":
-                    self.set_box_image(path_dir + file)
-                elif name == "object" or name == "obj":
-                    self.set_uncompressed_image(path_dir + file)
-                elif name.startswith("compression"):
-                    self.set_compressed_image(path_dir + file)
+                self._import_image(path_dir + file, stream)
+        return True
+    
+    def _import_archive(self, archive_path, stream):
+        bg_members = []
+        pending = [] # stored before the background images
+        members = read_archive(archive_path)
+        while True:
+            # Only errors reading the archive itself are caught; an image 
+            # that fails to load raises, as it does from a directory
+            try:
+                member = next(members)
+            except StopIteration:
+                break
+            except IOError:
+                return False
+            if pending is None: # background already set
+                self._import_image(member, stream)
+            elif _is_background(member.name):
+                bg_members.append(member)
+            elif bg_members: # background images complete
+                self._import_background(bg_members)
+                for held in pending:
+                    self._import_image(held, stream)
+                pending = None
+                self._import_image(member, stream)
+            else:
+                pending.append(member)
+        if pending is None:
+            return True
+        if bg_members:
+            self._import_background(bg_members)
+        if not self.bg_path:
+            return False
+        for held in pending:
+            self._import_image(held, stream)
         return True
     
+    def _import_background(self, bg_sources):
+        if len(bg_sources) > 1:
+            self.set_background_images(bg_sources)
+        else:
+            self.bg_path = bg_sources[0]
+        return
+    
+    def _import_image(self, source, stream):
+        name = os.path.splitext(os.path.basename(str(source)))[0]
+        if name in ("reference", "ref") and "measure" in self._calibrated:
+            return # already calibrated
+        if name == "arm" and "arm" in self._calibrated:
+            return
+        if name == "reference" or name == "ref":
+            self.set_measure_image(source, 100, 100)
+        elif name == "arm":
+            self.set_arm_image(source)
+        elif name == "box":
+            self.set_box_image(source)
+        elif name == "object" or name == "obj":
+            self.set_uncompressed_image(source)
+        elif name.startswith("compression") and stream:
+            self.compress_paths.append(source)
+        elif name.startswith("compression"):
+            self.set_compressed_image(source)
+        return
+    
     def set_roi(self, x, y, w, h, xy_type="absolute", dim_type="absolute"):
         '''
         Sets the rectangular region of interest for all images that are loaded
@@ -167,7 +292,26 @@ class BaxterExperiment(BaxterObject):
         self.set_box_roi(x, y, w, h, xy_type, dim_type)
         return
     
-    def display_results(self):
+    def set_preview(self, max_width=960):
+        '''
+        Sets display_results() to show previews of reduced resolution, which
+        are much faster to display and page through than full resolution 
+        images. Each preview is loaded at reduced size (decoded so directly 
+        from its file, where possible) and segmented at that size for the
+        displayed segment, while the displayed bounding rectangles are scaled
+        from the full resolution results. Full resolution is only shown 
+        when toggled with the 'f' key.
+        
+        Args:
+            max_width: maximum width of the previews, or None to always show
+                       full resolution.
+        '''
+        
+        self._preview_width = max_width
+        self._previews = {}
+        return
+    
+    def display_results(self, tune=False):
         '''
         Opens a window and displays the results of the BaxterExperiment's
         segmentation of its object images. The window contains a slider
@@ -181,18 +325,39 @@ class BaxterExperiment(BaxterObject):
             - Pressing 'r' toggles what bounding rectangle to display.
             - Pressing TAB temporarily displays the background image, allowing
               for quick comparison between the background and current image.
+            - Pressing 'f' toggles between preview and full resolution, if
+              preview mode is enabled (see set_preview()).
             
+        With tuning, the window also has trackbars for the parameters of the
+        compressed object segmentation: the arm color tolerances in hue, 
+        saturation, and value (if an arm image is set; see 
+        set_arm_tolerance()), the threshold (0 for the automatic threshold it
+        was opened with, None or "roi"; the series setting is kept; see
+        set_compressed_threshold()), and the region of interest, in percent
+        of the image (see set_compressed_roi()). A change only recomputes the
+        displayed image's affected masks, so it is shown right away; the 
+        other compressed images are updated when next used, and measured
+        in the background meanwhile. The chosen parameters are kept for
+        exporting results, and can be saved with save_calibration(). 
+        Released images (see set_measure_only()) cannot be re-tuned.
+        
         This method does not terminate until the user closes the window. Note 
         also that the keyboard functions have been tested to only completely 
         work on Windows.
+        
+        Args:
+            tune: whether to show the parameter trackbars.
         '''
         
         self._total = 5 + len(self.compress_obj)
+        self._previews = {} # images may have changed since last time
         
         #cv2.namedWindow(self._name)
         self._display_update(self._pos)
         cv2.cv.CreateTrackbar(self._bar, self._name, 0, 
                               self._total-1, self._display_update)
+        if tune:
+            self._create_tuning_trackbars()
         
         while True:
             k = cv2.waitKey()
@@ -218,20 +383,32 @@ class BaxterExperiment(BaxterObject):
                 self._seg = (self._seg + 1) % 3
             elif k == ord('r'):
                 self._rect = (self._rect + 1) % 3
+            elif k == ord('f'):
+                self._full = not self._full
             else:
                 continue
             self._display_update(self._pos)
         
+        self._tuning = False
+        self._stop_series_update() # the rest is updated when next used
         cv2.waitKey(-1) # for Linux
         cv2.destroyWindow(self._name)
         cv2.imshow(self._name, np.array([0])) # for Linux
         return
                  
     def _display_update(self, index):
-        bg_img = cv2.imread(self.bg_path)
+        with self._lock: # the series may be measured in the background
+            self._display(index)
+        return
+    
+    def _display(self, index):
+        bg_model = self._get_background()
+        scale = self._get_preview_scale()
+        if scale < 1.0:
+            bg_model = self._get_preview_background(scale)
+        bg_img = bg_model.img
         if index == 0:
-            # Apply the same blurring filter as in object_detect.py
-            cv2.imshow(self._name, cv2.bilateralFilter(bg_img, 5, 100, 100))
+            cv2.imshow(self._name, bg_img)
             return
         
         obj = None
@@ -250,36 +427,210 @@ class BaxterExperiment(BaxterObject):
             black_img = np.zeros(bg_img.shape[:-1], np.uint8)
             cv2.imshow(self._name, black_img)
             return
-             
-        if self._seg == 2:
-            obj_mask = obj.get_object_mask()
-            img = cv2.bitwise_and(obj.fg_img, obj.fg_img, mask=obj_mask)
+        
+        seg_obj = obj # segments the displayed image
+        if scale < 1.0 or obj.fg_img is None: # reload released images
+            preview = self._get_preview(index, obj, scale)
+            seg_obj = None if preview is None else preview[0]
+        if seg_obj is None: # released and not reloadable; geometry only
+            img = np.zeros(bg_img.shape, np.uint8)
+        elif self._seg == 2:
+            obj_mask = seg_obj.get_object_mask()
+            img = cv2.bitwise_and(seg_obj.fg_img, seg_obj.fg_img, mask=obj_mask)
         elif self._seg == 1:
-            region_mask = cv2.bitwise_and(obj.rect_mask, obj.color_mask)
-            img = cv2.bitwise_and(obj.fg_img, obj.fg_img, mask=region_mask)
+            region_mask = seg_obj.get_region_mask()
+            img = cv2.bitwise_and(seg_obj.fg_img, seg_obj.fg_img, mask=region_mask)
         else:
-            img = obj.fg_img.copy()
+            img = seg_obj.fg_img.copy()
             
-        if self._rect >= 1:
-            points = np.int0(obj.get_object_rectangle_points(self._rect == 2))
+        if self._rect >= 1: # from the full resolution result
+            points = obj.get_object_rectangle_points(self._rect == 2)
+            points = np.int0(np.array(points) * scale)
             cv2.drawContours(img, [points], 0, (255,255,255), 2)
             
         cv2.imshow(self._name, img)
         return
+    
+    def _get_preview_scale(self):
+        if self._preview_width is None or self._full:
+            return 1.0
+        width = self._get_background().img.shape[1]
+        return min(1.0, float(self._preview_width) / width)
+    
+    def _create_tuning_trackbars(self):
+        if not self.arm_obj is None:
+            tolerances = self._color_tol or [60, 96, 128]
+            for name, value, count in zip(TOLERANCE_BARS, tolerances, 
+                                          (180, 256, 256)):
+                cv2.createTrackbar(name, self._name, int(value), count, 
+                                   self._on_tolerance)
+        threshold = self._compress_threshold
+        value = 0 if threshold is None or threshold == "roi" else threshold
+        # 0 returns to the automatic threshold the window was opened with
+        self._auto_threshold = "roi" if threshold == "roi" else None
+        cv2.createTrackbar(THRESHOLD_BAR, self._name, int(value), 255, 
+                           self._on_threshold)
+        if self.compress_obj and not self.compress_obj[0].fg_img is None:
+            height, width = self.compress_obj[0].fg_img.shape[:2]
+            x, y, w, h = self._compress_rect or (0, 0, width, height)
+            values = (100*x / width, 100*y / height, 
+                      100*w / width, 100*h / height)
+            for name, value in zip(ROI_BARS, values):
+                cv2.createTrackbar(name, self._name, value, 100, self._on_roi)
+        self._tuning = True
+        return
+    
+    def _on_tolerance(self, value):
+        tolerances = [cv2.getTrackbarPos(name, self._name) 
+                      for name in TOLERANCE_BARS]
+        self._retune(lambda: self.set_arm_tolerance(*tolerances))
+        return
+    
+    def _on_threshold(self, value):
+        threshold = value if value > 0 else self._auto_threshold
+        series = self._threshold_series # kept as set
+        self._retune(lambda: self.set_compressed_threshold(threshold, series))
+        return
+    
+    def _on_roi(self, value):
+        x, y, w, h = [cv2.getTrackbarPos(name, self._name) for name in ROI_BARS]
+        self._retune(lambda: self.set_compressed_roi(x, y, max(1, w), 
+            max(1, h), "relative", "relative"))
+        return
+    
+    def _retune(self, apply):
+        # Applies a parameter change, which only marks the affected masks of
+        # the images, then shows the displayed image recomputed
+        if not self._tuning: # trackbars still being created
+            return
+        self._stop_series_update()
+        apply()
+        self._display_update(cv2.getTrackbarPos(self._bar, self._name))
+        self._update_series()
+        return
+    
+    def _update_series(self):
+        # Measures the compressed images in the background, one at a time,
+        # so most are up to date by the time results are exported
+        stop = threading.Event()
+        
+        def run():
+            for obj in list(self.compress_obj):
+                if stop.is_set():
+                    return
+                with self._lock:
+                    obj.measure()
+            return
+        
+        self._series_stop = stop
+        self._series_thread = threading.Thread(target=run, name="series-update")
+        self._series_thread.daemon = True
+        self._series_thread.start()
+        return
+    
+    def _stop_series_update(self):
+        if not self._series_thread is None:
+            self._series_stop.set()
+            self._series_thread.join()
+            self._series_thread = None
+        return
+    
+    def _get_preview(self, index, obj, scale):
+        if index in self._previews and self._previews[index][1] == scale:
+            self._sync_preview(self._previews[index][0], obj, scale)
+            return self._previews[index]
+        bg_model = self._get_preview_background(scale)
+        width = self._get_background().img.shape[1]
+        size = (bg_model.img.shape[1], bg_model.img.shape[0])
+        
+        # Decode at the largest reduction that is not smaller than the preview
+        reduce = 1
+        while reduce < 8 and width // (2*reduce) >= size[0]:
+            reduce *= 2
+        source = obj.fg_img if not obj.fg_img is None else obj.source
+        if source is None: # released, and decoded from memory
+            return None
+        filtered = source is obj.fg_img and obj.fg_filtered # not twice
+        try:
+            if source is obj.source and not self._undistorter is None:
+                source = self._undistorter.undistort(load_image(source, 
+                                                                "Preview"))
+            img = load_image(source, "Preview", reduce)
+        except IOError: # e.g. the file was moved since
+            return None
+        if img.shape[1] != size[0] or img.shape[0] != size[1]:
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        seg_obj = SegmentedObject(bg_model, img, self._method, 
+                                  threshold=obj.threshold, filtered=filtered)
+        self._sync_preview(seg_obj, obj, scale)
+        self._previews[index] = (seg_obj, scale)
+        return self._previews[index]
+    
+    def _sync_preview(self, seg_obj, obj, scale):
+        # Gives a preview the settings of its full resolution object, scaled;
+        # unchanged settings are no-ops
+        if not obj.color_range is None:
+            seg_obj.set_ignore_color(*obj.color_range)
+        if obj.rect is None:
+            seg_obj.reset_rectangle()
+        else:
+            x, y, w, h = obj.rect
+            seg_obj.set_rectangle(int(x * scale), int(y * scale), 
+                                  max(1, int(w * scale)), max(1, int(h * scale)))
+        if obj.search_rect is None:
+            seg_obj.reset_search_rectangle()
+        else:
+            x, y, w, h = obj.search_rect
+            seg_obj.set_search_rectangle(int(x * scale), int(y * scale), 
+                max(1, int(w * scale)), max(1, int(h * scale)))
+        seg_obj.set_threshold(obj.threshold)
+        if not self._cleanup is None:
+            operation, kernel_size = self._cleanup
+            seg_obj.set_cleanup(operation, max(1, int(kernel_size * scale)))
+        return
+    
+    def _get_preview_background(self, scale):
+        if 0 in self._previews and self._previews[0][1] == scale:
+            return self._previews[0][0]
+        bg_model = self._get_background()
+        height, width = bg_model.img.shape[:2]
+        self._previews[0] = (bg_model.scaled((int(width * scale), 
+                                              int(height * scale))), scale)
+        return self._previews[0][0]
+
+def _is_background(path):
+    '''
+    Helper function returning whether an image is named as a background image
+    (see BaxterExperiment.import_images()). Not to be used by user.
+    '''
+    
+    name = os.path.splitext(os.path.basename(path))[0]
+    return (name == "background" or name == "bg" or 
+            name.startswith("background-") or name.startswith("bg-"))
 
 # Test script for BaxterExperiment
 def main():
     parser = argparse.ArgumentParser(description="Process Baxter experiment images.")  
     parser.add_argument("-v", "--view", action="store_true", 
                         help="display results in window")
+    parser.add_argument("-p", "--preview", type=int, nargs="?", const=960,
+                        metavar="WIDTH",
+                        help="display previews at most WIDTH pixels wide "
+                             "(default: 960)")
+    parser.add_argument("--tune", action="store_true",
+                        help="add trackbars for the arm color tolerances, "
+                             "threshold, and ROI to the window, before "
+                             "exporting and saving calibration (implies -v)")
     parser.add_argument("-e", "--export", nargs=1, metavar="DIR",
                         help="export results to file directory")
     parser.add_argument("-i", "--import", nargs=1, metavar="DIR", dest="dir",
-                        help="load directory path of images to add")
+                        help="load directory path (or zip/tar archive) of "
+                             "images to add")
     parser.add_argument("-ie", nargs=1, metavar="DIR",
-                        help="load directory path of images and export to same")
-    parser.add_argument("-b", "--bg", nargs=1, metavar="FILE", 
-                        help="add background image")
+                        help="load directory path (or zip/tar archive) of "
+                             "images and export to same (its directory)")
+    parser.add_argument("-b", "--bg", nargs='+', metavar="FILE", 
+                        help="add background image(s)")
     parser.add_argument("-m", "--measure", nargs=1, metavar="FILE",
                         help="add measure reference image")
     parser.add_argument("-m-d", "--measure-dim", nargs=2, type=int, 
@@ -296,21 +647,106 @@ def main():
                          help="add uncompressed object image")
     parser.add_argument("-c", "--compression", nargs='+', metavar="FILE",
                         help="add compressed object image(s)")
+    parser.add_argument("-s", "--stream", action="store_true",
+                        help="stream imported compression images on export")
+    parser.add_argument("--method", default="simple",
+                        help="specify segmentation method")
+    parser.add_argument("--cleanup", nargs=2, metavar=("OPERATION", "SIZE"),
+                        help="specify morphological cleanup of the mask "
+                             "(open, close, or open-close) and kernel size")
+    parser.add_argument("--camera", metavar="FILE",
+                        help="remove lens distortion with camera calibration "
+                             "(.npz with camera_matrix and dist_coeffs)")
+    parser.add_argument("--calibration", metavar="FILE",
+                        help="load calibration profile, skipping reference "
+                             "and arm images")
+    parser.add_argument("--save-calibration", metavar="FILE",
+                        help="save calibration profile after loading images")
+    parser.add_argument("--measure-only", action="store_true",
+                        help="release compression images once measured")
+    parser.add_argument("-d", "--dedup", type=float, metavar="THRESHOLD",
+                        help="skip compression images that differ from the "
+                             "previous by less than THRESHOLD (0-255)")
+    parser.add_argument("--npz", action="store_true",
+                        help="also export sizes in binary NumPy format")
+    parser.add_argument("--video", action="store_true",
+                        help="export compression segments as one video "
+                             "(compression_seg.avi)")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+                        help="specify number of worker threads")
+    parser.add_argument("-t", "--cv-threads", type=int, metavar="N",
+                        help="specify number of OpenCV threads (one pool "
+                             "shared by all workers)")
+    parser.add_argument("--prefetch", type=int, metavar="N",
+                        help="load N compression images ahead while "
+                             "segmenting one at a time")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="serve segmentation requests on localhost PORT "
+                             "with the loaded settings")
+    parser.add_argument("--queue-size", type=int, default=16, metavar="N",
+                        help="specify maximum number of queued requests")
+    parser.add_argument("--timeout", type=float, default=30.0, 
+                        metavar="SECONDS",
+                        help="specify seconds to wait for a request's result "
+                             "(default: 30)")
+    parser.add_argument("--profile", nargs="?", const="view_baxter-profile",
+                        metavar="PREFIX",
+                        help="profile the run (per-function statistics of "
+                             "the main thread only), writing PREFIX.prof "
+                             "and PREFIX.txt (default: view_baxter-profile)")
     args = parser.parse_args()
+    if args.cleanup:
+        operation, size = args.cleanup
+        if (not operation in CLEANUP_OPERATIONS or not size.isdigit() or 
+            int(size) < 1):
+            parser.error("--cleanup OPERATION must be one of %s, and SIZE a "
+                         "positive integer" % ", ".join(CLEANUP_OPERATIONS))
+        args.cleanup = (operation, int(size))
+    if args.timeout <= 0:
+        parser.error("--timeout SECONDS must be positive")
+    if args.tune: # the trackbars are on the results window
+        args.view = True
     
+    if args.profile:
+        profiling.run_profiled(lambda: _run(args), args.profile)
+    else:
+        _run(args)
+    return
+
+def _run(args):
     baxter = BaxterExperiment()
+    workers, cv_threads = baxter.set_thread_budget(args.jobs, args.cv_threads)
+    print "Thread budget:", workers, "worker(s),", cv_threads, "OpenCV thread(s)"
+    if not baxter.set_segment_method(args.method):
+        print "Unknown segmentation method", args.method, "- using simple."
+    if args.cleanup and not baxter.set_cleanup(*args.cleanup):
+        print "Invalid mask cleanup", args.cleanup, "- using none."
+    if not args.dedup is None:
+        baxter.set_compressed_dedup(threshold=args.dedup)
+    if args.measure_only:
+        baxter.set_measure_only()
+    if args.prefetch:
+        baxter.set_prefetch(args.prefetch)
+    if args.camera and not baxter.set_camera_calibration(args.camera):
+        print "Camera calibration", args.camera, "not loaded - ignoring distortion."
+    if args.calibration:
+        print "Loading calibration profile", args.calibration, "...",
+        print "done." if baxter.load_calibration(args.calibration) else "failed."
     if args.dir:
         print "Importing files from", args.dir[0], "...",
-        baxter.import_images(args.dir[0])
+        baxter.import_images(args.dir[0], args.stream)
         print "done."
     elif args.ie:
         print "Importing files from", args.ie[0], "...",
-        baxter.import_images(args.ie[0])
+        baxter.import_images(args.ie[0], args.stream)
         print "done."
 
     if args.bg:
-        print "Setting background image to", args.bgv, "...",
-        baxter.bg_path = args.bg[0]
+        print "Setting background image(s) to", args.bg, "...",
+        if len(args.bg) > 1:
+            baxter.set_background_images(args.bg)
+        else:
+            baxter.bg_path = args.bg[0]
         print "done."
     if args.measure:
         f = args.measure[0]
@@ -354,26 +790,54 @@ def main():
     if baxter.bg_path:
         print "Baxter experiment successfully loaded. Have some stats:"    
         baxter.print_results()
+    if args.view and args.tune: # tune before the results are saved
+        _view(baxter, args)
+    if args.save_calibration:
+        print "Saving calibration profile to", args.save_calibration, "...",
+        print "done." if baxter.save_calibration(args.save_calibration) else "failed."
         
     if args.export:
         print "Exporting results to", args.export[0], "...",
-        if baxter.export_results(args.export[0]):
+        if baxter.export_results(args.export[0], binary=args.npz, 
+                                 video=args.video):
             print "done."
         else:
             print "nothing written. Are you sure that's a directory?"
     elif args.ie:
-        print "Exporting results to", args.ie[0], "...",
-        if baxter.export_results(args.ie[0]):
+        output_dir = args.ie[0]
+        if os.path.isfile(output_dir): # archive, export next to it
+            output_dir = os.path.dirname(output_dir) or "."
+        print "Exporting results to", output_dir, "...",
+        if baxter.export_results(output_dir, binary=args.npz, 
+                                 video=args.video):
             print "done."
         else:
             print "nothing written. Are you sure that's a directory?"        
             
-    if args.view:
-        print "Opening results window ...",
-        baxter.display_results()
-        print "closed."
+    if args.view and not args.tune:
+        _view(baxter, args)
+    if args.serve:
+        if not baxter.bg_path:
+            print "Cannot serve requests without a background image."
+        else:
+            service = obj_service.SegmentationService(baxter, 
+                                                      queue_size=args.queue_size)
+            print "Serving segmentation requests on port", args.serve, "...",
+            obj_service.serve(service, args.serve, timeout=args.timeout)
+            print "stopped."
     print "Finished executing. Goodbye."
     return
 
+def _view(baxter, args):
+    if args.preview:
+        baxter.set_preview(args.preview)
+    print "Opening results window ...",
+    baxter.display_results(args.tune)
+    print "closed."
+    if args.tune:
+        print "Tuned results:"
+        baxter.print_results()
+    return
+
 if __name__ == "__main__":
     main() 